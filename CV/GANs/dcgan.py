@@ -1,92 +1,221 @@
+import argparse
+import contextlib
+import dataclasses
+import os
+import time
+from dataclasses import dataclass
 from datetime import datetime
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.optim as optim
-from torchvision.utils import make_grid
-import matplotlib.pyplot as plt
-import numpy as np
+from torch.nn.parallel import DistributedDataParallel
 
 from models import discriminator as dsc
 from models import generator as gnr
-from utils import data_utils, loss_utils
-
-ngpu = torch.cuda.device_count()
-op_chnls = 3
-ftr_map_size_dc = 64
-ftr_map_size_gn = 64
-latent_vector_size = 100
-lr = 0.0002
-beta1 = 0.5
-beta2 = 0.999
-num_epochs = 5
-
-data_dir = "data"
-image_size = 64
-batch_size = 128
-num_workers = 0
-
-device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-
-netD = dsc.DCGANDiscriminator(op_chnls, ftr_map_size_dc)
-netG = gnr.DCGANGenerator(latent_vector_size, ftr_map_size_gn, op_chnls)
-netD.to(device)
-netG.to(device)
-
-if ngpu>1:
-    netD = nn.DataParallel(netD)
-    netG = nn.DataParallel(netG)
-
-criterion = loss_utils.get_bce_loss()
-optimizerD = optim.Adam(netD.parameters(), lr = lr, betas = (beta1, beta2))
-optimizerG = optim.Adam(netG.parameters(), lr = lr, betas = (beta1, beta2))
-
-fixed_noise = torch.randn(64, latent_vector_size, 1, 1).to(device)
-
-real_label_identifier = 1
-fake_label_identifier = 0
-
-log_file = "TrainingLog_" + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ".txt"
-with open(log_file, "a") as f:
-    f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    f.write("\n")
-    f.write("Starting operation")
-    f.write("\n")
-    f.write("\n")
-
-dataloader = data_utils.get_datloader(data_dir, image_size, batch_size, True, num_workers)
-G_losses = []
-D_losses = []
-gen_image_list = []
-total_iters = num_epochs * len(dataloader)
-
-for epoch in range (num_epochs):
-    for i, data in enumerate(dataloader, 0):
+from utils import data_utils, loss_utils, shard_utils
+from utils.checkpoint_utils import get_rng_state, set_rng_state, strip_module_prefix, unwrap
+from utils.hook_utils import CheckpointHook, LoggingHook, PlotHook, SamplingHook
+
+
+@dataclass
+class DCGANConfig:
+    """
+    Hyperparameters and settings of a DCGAN training run. Every field is also a command line option of dcgan.py.
+    """
+    data_dir: str = "data"
+    # read pre-resized images from the shards written by prepare_shards.py instead of data_dir
+    shard_dir: str = None
+    out_dir: str = "."
+    image_size: int = 64
+    # the global batch size, split between the processes in distributed training
+    batch_size: int = 128
+    num_workers: int = 0
+    num_epochs: int = 5
+    op_chnls: int = 3
+    ftr_map_size_dc: int = 64
+    ftr_map_size_gn: int = 64
+    latent_vector_size: int = 100
+    lr: float = 0.0002
+    beta1: float = 0.5
+    beta2: float = 0.999
+    seed: int = 0
+    # stop after this many iterations, e.g. for benchmarks
+    max_iters: int = None
+    log_every: int = 50
+    sample_every: int = 500
+    checkpoint_dir: str = "checkpoints"
+    checkpoint_every: int = None
+    keep_last: int = 3
+    # a checkpoint path, or "latest" for the latest one in checkpoint_dir
+    resume: str = None
+    quiet: bool = False
+    # synchronize the batch norm statistics across processes in distributed training.
+    # SyncBatchNorm only works on gpus, it is rejected on the cpu
+    sync_batchnorm: bool = False
+
+
+class DCGANTrainer:
+    """
+    Trains a DCGAN generator and discriminator as described by a DCGANConfig.
+
+    The trainer only runs the optimization. Everything else (logging, sampling, checkpointing, plots) is done
+    by hooks, see utils.hook_utils, so that the same trainer can run from the command line, a benchmark or a sweep.
+
+    With world_size > 1, the trainer runs in every process of an initialized process group. Both networks are
+    wrapped in DistributedDataParallel and every process trains on its own shard of the images.
+    """
+
+    def __init__(self, config, hooks = (), device = None, rank = 0, world_size = 1) -> None:
+        """
+        Keyword Arguments:
+        config: the DCGANConfig of the run
+        hooks: the hooks called during training, in order
+        device: the device to train on, the first gpu if there is one by default
+        rank: rank of this process in distributed training
+        world_size: number of processes in distributed training
+        """
+        self.config = config
+        self.hooks = list(hooks)
+        self.device = device or torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        self.rank = rank
+        self.world_size = world_size
+        distributed = world_size > 1
+        torch.manual_seed(config.seed)
+
+        self.netD = dsc.DCGANDiscriminator(config.op_chnls, config.ftr_map_size_dc).to(self.device)
+        self.netG = gnr.DCGANGenerator(config.latent_vector_size, config.ftr_map_size_gn, config.op_chnls).to(self.device)
+        if config.sync_batchnorm and distributed and self.device.type != "cuda":
+            raise ValueError("--sync-batchnorm requires gpus, DistributedDataParallel doesn't support SyncBatchNorm "
+                "on the cpu")
+        if distributed:
+            if config.sync_batchnorm:
+                self.netD = nn.SyncBatchNorm.convert_sync_batchnorm(self.netD)
+                self.netG = nn.SyncBatchNorm.convert_sync_batchnorm(self.netG)
+            self.netD = DistributedDataParallel(self.netD)
+            self.netG = DistributedDataParallel(self.netG)
+        elif torch.cuda.device_count() > 1:
+            self.netD = nn.DataParallel(self.netD)
+            self.netG = nn.DataParallel(self.netG)
+
+        self.criterion = loss_utils.get_bce_loss()
+        betas = (config.beta1, config.beta2)
+        self.optimizerD = optim.Adam(self.netD.parameters(), lr = config.lr, betas = betas)
+        self.optimizerG = optim.Adam(self.netG.parameters(), lr = config.lr, betas = betas)
+
+        self.fixed_noise = torch.randn(64, config.latent_vector_size, 1, 1).to(self.device)
+        # every process draws different noise
+        torch.manual_seed(config.seed + rank)
+
+        batch_size = max(1, config.batch_size // world_size)
+        if config.shard_dir:
+            self.dataloader = shard_utils.get_shard_loader(config.shard_dir, batch_size, True, config.num_workers,
+                config.seed, pin_memory = self.device.type == "cuda", rank = rank, world_size = world_size)
+            if self.dataloader.dataset.index["image_size"] != config.image_size:
+                raise ValueError("The shards hold {0}x{0} images, not {1}x{1}".format(
+                    self.dataloader.dataset.index["image_size"], config.image_size))
+        else:
+            self.dataloader = data_utils.get_datloader(config.data_dir, config.image_size, batch_size, True,
+                config.num_workers, config.seed, pin_memory = self.device.type == "cuda", distributed = distributed)
+
+        # the dataloader only holds the rest of the epoch when resuming in the middle of one
+        self.batches_per_epoch = len(self.dataloader)
+
+        # label and noise buffers, allocated on the device once instead of at every iteration.
+        # The last batch of an epoch may be smaller, it uses the beginning of the buffers.
+        self.real_label = torch.full((batch_size, 1), 1, dtype=torch.float32, device=self.device)
+        self.fake_label = torch.full((batch_size, 1), 0, dtype=torch.float32, device=self.device)
+        self.noise = torch.empty(batch_size, config.latent_vector_size, 1, 1, dtype=torch.float32,
+            device=self.device)
+
+        # filled by the hooks, saved in the checkpoints
+        self.history = {"G_losses": [], "D_losses": [], "gen_images": []}
+        # the next batch to train on
+        self.epoch = 0
+        self.iteration = 0
+
+    def global_iteration(self):
+        return self.epoch * self.batches_per_epoch + self.iteration
+
+    def state_dict(self):
+        # the networks are saved unwrapped, so that a checkpoint can be resumed with any number of processes
+        return {"netD": unwrap(self.netD).state_dict(), "netG": unwrap(self.netG).state_dict(),
+            "optimizerD": self.optimizerD.state_dict(), "optimizerG": self.optimizerG.state_dict(),
+            "rng": get_rng_state(), "fixed_noise": self.fixed_noise, "history": self.history,
+            "epoch": self.epoch, "iteration": self.iteration}
+
+    def load_state_dict(self, state):
+        unwrap(self.netD).load_state_dict(strip_module_prefix(state["netD"]))
+        unwrap(self.netG).load_state_dict(strip_module_prefix(state["netG"]))
+        self.optimizerD.load_state_dict(state["optimizerD"])
+        self.optimizerG.load_state_dict(state["optimizerG"])
+        set_rng_state(state["rng"])
+        if self.rank > 0:
+            # the checkpoint holds the random state of rank 0, the other processes must keep drawing
+            # different noise. The seed also depends on where training resumes, so that the noise
+            # drawn before the checkpoint isn't drawn again.
+            torch.manual_seed(self.config.seed + self.rank + self.world_size * (
+                state["epoch"] * self.batches_per_epoch + state["iteration"]))
+        self.fixed_noise = state["fixed_noise"].to(self.device)
+        self.history = state["history"]
+        self.history["gen_images"] = [image.to(self.device) for image in self.history["gen_images"]]
+        self.epoch, self.iteration = state["epoch"], state["iteration"]
+
+    def no_sync(self, net):
+        """
+        Don't all-reduce the gradients of net in the backward passes run in this context.
+        """
+        return net.no_sync() if isinstance(net, DistributedDataParallel) else contextlib.nullcontext()
+
+    def call_hooks(self, event, *args):
+        for hook in self.hooks:
+            getattr(hook, event)(self, *args)
+
+    def sample(self, noise = None):
+        """
+        Generate images from noise, the fixed noise by default.
+
+        The hooks sample on rank 0 only, so the generator is run unwrapped: the forward of DistributedDataParallel
+        broadcasts the batch norm buffers, a collective the other processes would never join.
+        """
+        with torch.no_grad():
+            return unwrap(self.netG)(self.fixed_noise if noise is None else noise).detach()
+
+    def train_step(self, imgs):
+        """
+        Train the discriminator and then the generator on one batch of real images.
+
+        Returns:
+        errD, errG: the loss tensors of the discriminator and the generator
+        """
+        netD, netG, criterion = self.netD, self.netG, self.criterion
+
         # get rid of any residual gradients
         netD.zero_grad()
         netG.zero_grad()
 
-        # getitem in ImageFolder returns 2 objects - image tensor and labels. 
-        # Retrieve image tensor
-        imgs = data[0].to(device)
         batch_size = len(imgs)
-        
-        # create real_label and fake_label tensors to be used for calculating loss 
-        real_label = torch.full((batch_size, 1), real_label_identifier, dtype=torch.float32).to(device)
-        fake_label = torch.full((batch_size, 1), fake_label_identifier, dtype=torch.float32).to(device)
+
+        # real_label and fake_label tensors used for calculating loss
+        real_label = self.real_label[:batch_size]
+        fake_label = self.fake_label[:batch_size]
 
 
         ##################################
         ##    Training Discriminator    ##
-        ################################## 
-        
-        # Train discriminator on real data
-        output = netD(imgs).view(-1).unsqueeze(1)
-        errD_real = criterion(output, real_label)
-        errD_real.backward()
+        ##################################
+
+        # Train discriminator on real data. In distributed training, the gradients of the real and
+        # the fake batch are all-reduced together, by the second backward.
+        with self.no_sync(netD):
+            output = netD(imgs).view(-1).unsqueeze(1)
+            errD_real = criterion(output, real_label)
+            errD_real.backward()
 
         # Train discriminator on fake data
-        # Generate fake data first
-        noise = torch.randn(batch_size, latent_vector_size, 1, 1, dtype=torch.float32).to(device)
+        # Generate fake data first, the noise is drawn on the device
+        noise = self.noise[:batch_size].normal_()
         fake_imgs = netG(noise)
         output = netD(fake_imgs.detach()).view(-1).unsqueeze(1)
         errD_fake = criterion(output, fake_label)
@@ -94,90 +223,158 @@ for epoch in range (num_epochs):
 
         # get total loss for discriminator
         errD = errD_real + errD_fake
-        lossD = errD.item()
 
         # step through the optimizer for discriminator
-        optimizerD.step()
+        self.optimizerD.step()
 
 
         ##################################
         ##      Training Generator      ##
-        ################################## 
-        
+        ##################################
+
         # as we have applied optimizer.step on discriminator once,
         # we need to generate the output from discriminator once again.
-        output = netD(fake_imgs).view(-1).unsqueeze(1)
-        
-        # While training the generator, real_label is the target
-        errG = criterion(output, real_label)
-        lossG = errG.item()
-        errG.backward()
-        
+        # The discriminator gradients of this pass are thrown away, they are not all-reduced.
+        with self.no_sync(netD):
+            output = netD(fake_imgs).view(-1).unsqueeze(1)
+
+            # While training the generator, real_label is the target
+            errG = criterion(output, real_label)
+            errG.backward()
+
         # step through the optimizer for generator
-        optimizerG.step()
-        
-        if (i % 50 == 0):
-            G_losses.append(errG.item())
-            D_losses.append(errD.item())
-
-
-            log_text = ("Epoch {cur_epch}/{epc}, Iteration: {cur_itr}/{itrs} \tLoss_G: {lg:.4f}\tLoss_D: {ld:.4f}".format
-                (cur_epch=epoch+1, epc=num_epochs, cur_itr=i+1, itrs=len(dataloader), lg=errG.item(), ld=errD.item()))
-            print (log_text)
-
-            with open(log_file, "a") as f:
-                f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                f.write("\n")
-                f.write(log_text)
-                f.write("\n")
-                f.write("\n")
-            
-        if (i % 500 == 0):
-            gen_image = netG(fixed_noise)
-            gen_image_list.append(gen_image.detach()[0:8, :, :, :])
-        print ("\n")
-
-    netD_checkpoint = "checkpoint_netD_" + str(epoch) + ".pt"
-    netG_checkpoint = "checkpoint_netG_" + str(epoch) + ".pt"
-    torch.save(netD.state_dict(), netD_checkpoint)
-    torch.save(netG.state_dict(), netG_checkpoint)
-
-torch.save(netD.state_dict(), "netD_final.pt")
-torch.save(netG.state_dict(), "netG_final.pt")
-
-# plot the losses over iterations
-iters = np.linspace(0, total_iters, len(G_losses))
-
-f = plt.figure()
-f.set_figwidth(8)
-f.set_figheight(8)
-plt.plot(iters, G_losses, color="red", label="G_loss")
-plt.plot(iters, D_losses, color="yellow", label="D_loss")
-plt.title("Losses vs Iterations")
-plt.ylabel("Loss")
-plt.xlabel("Iteration")
-plt.legend()
-plt.savefig("loss_iter.png")
-
-# save generated images after 500 iterations to disk
-gen_image_tensor = torch.cat(gen_image_list, 0)
-grid = make_grid(gen_image_tensor.detach().cpu().clone(), padding = 5, normalize=True)
-f = plt.figure(clear=True)
-plt.imshow(grid.permute(1,2,0))
-plt.axis("off")
-plt.savefig("generated_images.png")
-
-# save last batch of generated images to disk
-f = plt.figure(clear=True)
-grid = make_grid(gen_image_list[len(gen_image_list)-1].detach().cpu().clone(), 
-    padding = 5, normalize=True)
-plt.imshow(grid.permute(1,2,0))
-plt.axis("off")
-plt.savefig("last_generated.png")
-
-with open(log_file, "a") as f:
-    f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    f.write("\n")
-    f.write("Ending operation")
-    f.write("\n")
-    f.write("\n")
+        self.optimizerG.step()
+
+        return errD.detach(), errG.detach()
+
+    def train(self):
+        """
+        Train until config.num_epochs (or config.max_iters iterations) and call the hooks along the way.
+
+        Returns:
+        a summary of the run: number of iterations and images, duration, iterations/sec and images/sec
+        """
+        self.call_hooks("on_train_start")
+        num_iters = 0
+        num_images = 0
+        start_time = time.perf_counter()
+
+        while self.epoch < self.config.num_epochs:
+            epoch = self.epoch
+            # the order of the batches only depends on the seed and the epoch, so that an interrupted epoch
+            # is replayed in the same order; the batches it already trained on are skipped without being loaded
+            data_utils.set_epoch(self.dataloader, epoch, self.iteration)
+            for i, data in enumerate(self.dataloader, self.iteration):
+                # getitem in ImageFolder returns 2 objects - image tensor and labels.
+                # Retrieve image tensor. Shards hold uint8 images, normalized on the device.
+                if data[0].dtype == torch.uint8:
+                    imgs = shard_utils.normalize(data[0], self.device)
+                else:
+                    imgs = data[0].to(self.device, non_blocking=True)
+                errD, errG = self.train_step(imgs)
+
+                self.iteration = i + 1
+                num_iters += 1
+                num_images += len(imgs)
+                self.call_hooks("on_iteration_end", epoch, i, errD, errG)
+                if self.config.max_iters and num_iters >= self.config.max_iters:
+                    break
+
+            if self.config.max_iters and num_iters >= self.config.max_iters:
+                break
+            self.epoch, self.iteration = epoch + 1, 0
+            self.call_hooks("on_epoch_end", epoch)
+
+        elapsed = time.perf_counter() - start_time
+        self.call_hooks("on_train_end")
+        return {"iterations": num_iters, "images": num_images, "seconds": elapsed,
+            "iters_per_sec": num_iters / elapsed, "images_per_sec": num_images / elapsed}
+
+
+def default_hooks(config):
+    """
+    The hooks of a regular training run: checkpoints, a log file, samples from the fixed noise and plots,
+    all of them in config.out_dir.
+    """
+    log_file = os.path.join(config.out_dir, "TrainingLog_" + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ".txt")
+    return [CheckpointHook(os.path.join(config.out_dir, config.checkpoint_dir), config.out_dir, config.checkpoint_every,
+            config.keep_last, config.resume),
+        LoggingHook(log_file, config.log_every, not config.quiet),
+        SamplingHook(config.sample_every),
+        PlotHook(config.out_dir)]
+
+def distributed_hooks(config, rank):
+    """
+    The hooks of a process of distributed training: rank 0 logs, samples and saves like a regular run,
+    the other processes only resume from the checkpoint.
+    """
+    if rank == 0:
+        return default_hooks(config)
+    return [CheckpointHook(os.path.join(config.out_dir, config.checkpoint_dir), config.out_dir, resume = config.resume,
+        save = False)]
+
+def run_worker(local_rank, config, args):
+    """
+    Train in one process of distributed training (gloo backend) and print the throughput of all the processes on rank 0.
+    """
+    rank = args.node_rank * args.nprocs + local_rank
+    world_size = args.nnodes * args.nprocs
+    dist.init_process_group("gloo", rank = rank, world_size = world_size)
+    # don't let every process use all the cores
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.nprocs))
+
+    trainer = DCGANTrainer(config, distributed_hooks(config, rank), torch.device("cpu"), rank, world_size)
+    summary = trainer.train()
+    num_images = torch.tensor(float(summary["images"]))
+    dist.all_reduce(num_images)
+    dist.destroy_process_group()
+    if rank == 0:
+        summary["images_per_sec"] = num_images.item() / summary["seconds"]
+        print_summary(summary, world_size)
+
+def print_summary(summary, world_size = 1):
+    print("{iterations} iterations in {seconds:.1f}s, {iters_per_sec:.2f} iterations/sec, "
+        "{images_per_sec:.1f} images/sec".format(**summary) + " with {} processes".format(world_size))
+
+def get_parser():
+    """
+    An argument parser with one option per DCGANConfig field, e.g. --batch-size for batch_size,
+    and the options of distributed training.
+    """
+    parser = argparse.ArgumentParser(description = "Train a DCGAN on the images of --data-dir.")
+    parser.add_argument("--nprocs", type = int, default = 1, help = "processes per host, for distributed data "
+        "parallel training over the gloo backend")
+    parser.add_argument("--nnodes", type = int, default = 1, help = "number of hosts")
+    parser.add_argument("--node-rank", type = int, default = 0, help = "rank of this host")
+    parser.add_argument("--master-addr", default = "127.0.0.1", help = "address of the host with node rank 0")
+    parser.add_argument("--master-port", default = "29500")
+    for field in dataclasses.fields(DCGANConfig):
+        option = "--" + field.name.replace("_", "-")
+        if field.type is bool:
+            parser.add_argument(option, action = "store_true")
+        elif field.name == "resume":
+            parser.add_argument(option, nargs = "?", const = "latest", default = None)
+        else:
+            parser.add_argument(option, type = field.type, default = field.default)
+    return parser
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    # the processes of distributed training run on the cpu
+    if args.sync_batchnorm and args.nprocs * args.nnodes > 1:
+        parser.error("--sync-batchnorm requires gpus, DistributedDataParallel doesn't support SyncBatchNorm on the cpu")
+    config = DCGANConfig(**{field.name: getattr(args, field.name) for field in dataclasses.fields(DCGANConfig)})
+    os.makedirs(config.out_dir, exist_ok = True)
+
+    if args.nprocs * args.nnodes == 1:
+        print_summary(DCGANTrainer(config, default_hooks(config)).train())
+        return
+
+    os.environ["MASTER_ADDR"] = args.master_addr
+    os.environ["MASTER_PORT"] = str(args.master_port)
+    mp.spawn(run_worker, args = (config, args), nprocs = args.nprocs)
+
+
+if __name__ == "__main__":
+    main()
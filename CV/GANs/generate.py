@@ -0,0 +1,158 @@
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from models import generator as gnr
+from utils.checkpoint_utils import strip_module_prefix
+
+
+def load_generator(checkpoint, latent_vector_size = 100, ftr_map_size_gn = 64, op_chnls = 3, device = "cpu"):
+    """
+    Load a generator saved by training (e.g. netG_final.pt) in eval mode.
+
+    Keyword arguments:
+    checkpoint: path of the state_dict. The "module." prefix added by DataParallel and
+        DistributedDataParallel is removed.
+    latent_vector_size, ftr_map_size_gn, op_chnls: the DCGANConfig values the generator was trained with
+    device: the device to load the generator on
+
+    Returns:
+    the DCGANGenerator
+    """
+    state_dict = torch.load(checkpoint, map_location = "cpu")
+    state_dict = strip_module_prefix(state_dict)
+    netG = gnr.DCGANGenerator(latent_vector_size, ftr_map_size_gn, op_chnls)
+    netG.load_state_dict(state_dict)
+    return netG.to(device).eval()
+
+def to_uint8(images):
+    """
+    Map a [B, C, H, W] batch of generator outputs in [-1, 1] to a [B, H, W, C] uint8 array.
+    """
+    images = images.float().add_(1).mul_(127.5).clamp_(0, 255).to(torch.uint8)
+    return images.permute(0, 2, 3, 1).cpu().numpy()
+
+def save_pngs(images, out_dir, start):
+    for offset, image in enumerate(images):
+        Image.fromarray(image.squeeze()).save(os.path.join(out_dir, "{:08d}.png".format(start + offset)))
+
+def get_peak_memory_mb(device):
+    """
+    Peak resident memory of the process, and peak allocated memory of the gpu if device is one, in MB.
+    """
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    if device.type == "cuda":
+        return peak_mb, torch.cuda.max_memory_allocated(device) / (1024 * 1024)
+    return peak_mb, None
+
+def generate(netG, num_images, batch_size, out_dir, seed = 0, output_format = "png", num_threads = 4,
+    bf16 = False, channels_last = False):
+    """
+    Generate num_images images in batches of batch_size and write them to out_dir, either as one PNG
+    per image or as a single packed [N, H, W, C] uint8 images.npy.
+
+    The noise comes from a generator seeded with seed, so the same seed and batch size always give the same
+    images. The images are converted to uint8 on the device, the files are written by a pool of num_threads
+    threads while the next batch is generated. At most 2 * num_threads batches wait to be written.
+
+    Keyword arguments:
+    netG: the generator in eval mode
+    bf16: run the generator under bfloat16 autocast
+    channels_last: run the generator in the channels last memory format
+
+    Returns:
+    the number of seconds it took
+    """
+    device = next(netG.parameters()).device
+    latent_vector_size = netG.main[0].in_channels
+    if channels_last:
+        netG = netG.to(memory_format = torch.channels_last)
+    os.makedirs(out_dir, exist_ok = True)
+
+    noise_generator = torch.Generator().manual_seed(seed)
+    packed = None
+    executor = ThreadPoolExecutor(num_threads)
+    slots = threading.BoundedSemaphore(2 * num_threads)
+    futures = []
+
+    def write_done(future):
+        slots.release()
+
+    start_time = time.perf_counter()
+    with torch.inference_mode(), torch.autocast(device.type, dtype = torch.bfloat16, enabled = bf16):
+        for start in range(0, num_images, batch_size):
+            count = min(batch_size, num_images - start)
+            noise = torch.randn(count, latent_vector_size, 1, 1, generator = noise_generator).to(device)
+            if channels_last:
+                noise = noise.contiguous(memory_format = torch.channels_last)
+            images = to_uint8(netG(noise))
+
+            if output_format == "npy" and packed is None:
+                packed = np.lib.format.open_memmap(os.path.join(out_dir, "images.npy"), mode = "w+", dtype = np.uint8,
+                    shape = (num_images,) + images.shape[1:])
+
+            # raise the error of a writer as soon as it is done (e.g. on a full disk), not after the last batch
+            pending = []
+            for future in futures:
+                if future.done():
+                    future.result()
+                else:
+                    pending.append(future)
+            futures = pending
+
+            slots.acquire()
+            if output_format == "npy":
+                future = executor.submit(packed.__setitem__, slice(start, start + count), images)
+            else:
+                future = executor.submit(save_pngs, images, out_dir, start)
+            future.add_done_callback(write_done)
+            futures.append(future)
+
+    executor.shutdown(wait = True)
+    # raise the first error of the last writers, if any
+    for future in futures:
+        future.result()
+    if packed is not None:
+        packed.flush()
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate images with a trained DCGAN generator.")
+    parser.add_argument("--checkpoint", default = "netG_final.pt", help = "the state_dict of the generator")
+    parser.add_argument("--num-images", type = int, default = 10000)
+    parser.add_argument("--batch-size", type = int, default = 1024)
+    parser.add_argument("--seed", type = int, default = 0, help = "seed of the noise")
+    parser.add_argument("--out-dir", default = "generated")
+    parser.add_argument("--format", choices = ["png", "npy"], default = "png", help = "one PNG per image, or all "
+        "the images packed into a single uint8 images.npy")
+    parser.add_argument("--threads", type = int, default = 4, help = "number of writer threads")
+    parser.add_argument("--bf16", action = "store_true", help = "run the generator under bfloat16 autocast")
+    parser.add_argument("--channels-last", action = "store_true", help = "use the channels last memory format")
+    parser.add_argument("--latent-vector-size", type = int, default = 100)
+    parser.add_argument("--ftr-map-size-gn", type = int, default = 64)
+    parser.add_argument("--op-chnls", type = int, default = 3)
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    netG = load_generator(args.checkpoint, args.latent_vector_size, args.ftr_map_size_gn, args.op_chnls, device)
+    elapsed = generate(netG, args.num_images, args.batch_size, args.out_dir, args.seed, args.format, args.threads,
+        args.bf16, args.channels_last)
+
+    peak_rss, peak_gpu = get_peak_memory_mb(device)
+    print("Generated {} images in {:.1f}s ({:.1f} images/sec)".format(args.num_images, elapsed, args.num_images / elapsed))
+    print("Peak RSS: {:.0f} MB".format(peak_rss) + ("" if peak_gpu is None else ", peak gpu memory: {:.0f} MB".format(peak_gpu)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import argparse
+import time
+
+from utils import shard_utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Resize the images of an ImageFolder once and pack them into "
+        "uint8 shards, for dcgan.py --shard-dir.")
+    parser.add_argument("data_dir", help = "the ImageFolder directory")
+    parser.add_argument("shard_dir", help = "the directory the shards are written to")
+    parser.add_argument("--image-size", type = int, default = 64)
+    parser.add_argument("--shard-size", type = int, default = 10000, help = "images per shard")
+    parser.add_argument("--workers", type = int, default = 4, help = "number of decoding processes")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    index = shard_utils.write_shards(args.data_dir, args.shard_dir, args.image_size, args.shard_size, args.workers)
+    elapsed = time.perf_counter() - start_time
+    print("Wrote {} images into {} shards in {:.1f}s ({:.1f} images/sec)".format(index["num_images"],
+        len(index["shards"]), elapsed, index["num_images"] / elapsed))
+
+
+if __name__ == "__main__":
+    main()
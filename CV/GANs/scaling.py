@@ -0,0 +1,32 @@
+import argparse
+import re
+import subprocess
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Throughput of distributed DCGAN training with an increasing number "
+        "of processes on this host, and the scaling efficiency compared to a single process.")
+    parser.add_argument("--data-dir", default = "data")
+    parser.add_argument("--procs", type = int, nargs = "+", default = [1, 2, 4, 8])
+    parser.add_argument("--max-iters", type = int, default = 50, help = "iterations per run")
+    parser.add_argument("--batch-size", type = int, default = 128, help = "global batch size, the same for every run")
+    parser.add_argument("--out-dir", default = "scaling")
+    args = parser.parse_args()
+
+    results = []
+    for nprocs in args.procs:
+        command = [sys.executable, "dcgan.py", "--data-dir", args.data_dir, "--batch-size", str(args.batch_size),
+            "--max-iters", str(args.max_iters), "--out-dir", "{}/procs_{}".format(args.out_dir, nprocs),
+            "--quiet", "--nprocs", str(nprocs)]
+        output = subprocess.run(command, capture_output = True, text = True, check = True).stdout
+        results.append((nprocs, float(re.search(r"([0-9.]+) images/sec", output).group(1))))
+
+    base = results[0][1] / results[0][0]
+    print("{:>9} {:>12} {:>11}".format("processes", "images/sec", "efficiency"))
+    for nprocs, throughput in results:
+        print("{:>9} {:>12.1f} {:>11.1%}".format(nprocs, throughput, throughput / (base * nprocs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import dataclasses
+import itertools
+import multiprocessing as mp
+import os
+
+import torch
+
+from dcgan import DCGANConfig, DCGANTrainer, default_hooks
+
+
+def run(config, num_threads):
+    """
+    Train one configuration of the sweep, in a process of its own.
+    """
+    torch.set_num_threads(num_threads)
+    os.makedirs(config.out_dir, exist_ok = True)
+    trainer = DCGANTrainer(config, default_hooks(config))
+    summary = trainer.train()
+    summary["G_loss"] = trainer.history["G_losses"][-1] if trainer.history["G_losses"] else float("nan")
+    summary["D_loss"] = trainer.history["D_losses"][-1] if trainer.history["D_losses"] else float("nan")
+    return summary
+
+def parse_bool(value):
+    """
+    Parse true/false or 1/0, bool("False") being True.
+    """
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise ValueError("{} is not a boolean, use true/false or 1/0".format(value))
+
+def parse_grid(grid):
+    """
+    Parse the name=value1,value2,... arguments of --grid into a dict of DCGANConfig field -> list of values.
+    """
+    types = {field.name: field.type for field in dataclasses.fields(DCGANConfig)}
+    values = {}
+    for item in grid:
+        name, _, options = item.partition("=")
+        name = name.replace("-", "_")
+        if name not in types:
+            raise ValueError("{} is not a DCGANConfig field".format(name))
+        parse = parse_bool if types[name] is bool else types[name]
+        values[name] = [parse(option) for option in options.split(",")]
+    return values
+
+def main():
+    parser = argparse.ArgumentParser(description = "Train the DCGAN for every combination of hyperparameters of a grid, "
+        "several runs in parallel, and compare their throughput and losses.")
+    parser.add_argument("--grid", nargs = "+", required = True, help = "name=value1,value2,... of DCGANConfig fields, "
+        "e.g. lr=0.0002,0.0001 batch_size=64,128")
+    parser.add_argument("--data-dir", default = "data")
+    parser.add_argument("--out-dir", default = "sweep", help = "every run writes to a sub directory of this one")
+    parser.add_argument("--epochs", type = int, default = 1)
+    parser.add_argument("--max-iters", type = int, help = "stop every run after this many iterations")
+    parser.add_argument("--parallel", type = int, default = 2, help = "number of runs at the same time")
+    args = parser.parse_args()
+
+    grid = parse_grid(args.grid)
+    names = list(grid)
+    configs = []
+    for run_index, values in enumerate(itertools.product(*grid.values())):
+        configs.append(DCGANConfig(data_dir = args.data_dir, out_dir = os.path.join(args.out_dir, "run_" + str(run_index)),
+            num_epochs = args.epochs, max_iters = args.max_iters, quiet = True, **dict(zip(names, values))))
+
+    # the cores are shared between the runs of a round
+    num_threads = max(1, (os.cpu_count() or 1) // args.parallel)
+    with mp.get_context("spawn").Pool(args.parallel) as pool:
+        summaries = pool.starmap(run, [(config, num_threads) for config in configs])
+
+    print("{:<8} {:<40} {:>10} {:>11} {:>8} {:>8}".format("run", "config", "iters/sec", "images/sec", "Loss_G", "Loss_D"))
+    for run_index, (config, summary) in enumerate(zip(configs, summaries)):
+        params = ", ".join("{}={}".format(name, getattr(config, name)) for name in names)
+        print("{:<8} {:<40} {:>10.2f} {:>11.1f} {:>8.4f} {:>8.4f}".format("run_" + str(run_index), params,
+            summary["iters_per_sec"], summary["images_per_sec"], summary["G_loss"], summary["D_loss"]))
+
+
+if __name__ == "__main__":
+    main()
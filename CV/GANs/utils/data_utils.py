@@ -1,8 +1,15 @@
+import itertools
+
 import torch
+import torch.distributed as dist
 import torchvision.datasets as dset
 import torchvision.transforms as transforms
+from torch.utils.data import DistributedSampler
+
+from utils.shard_utils import ShardDataset
 
-def get_datloader(data_dir, image_size, batch_size, shuffle, num_workers):
+def get_datloader(data_dir, image_size, batch_size, shuffle, num_workers, seed = None, pin_memory = False,
+    distributed = False):
     """
     Create a dataset and dataloader from data_dir, returns dataloader.
 
@@ -12,6 +19,11 @@ def get_datloader(data_dir, image_size, batch_size, shuffle, num_workers):
     batch_size: the size of the batch for dataloader.
     shuffle: whether data should be shuffled or not in the dataloader.
     num_workers: number of worker threads to use.
+    seed: sample through a ResumableSampler seeded with seed, the order of an epoch is then reproducible
+        and an interrupted epoch can be resumed. See set_epoch.
+    pin_memory: return batches in pinned memory, so that they can be copied to the gpu asynchronously.
+    distributed: give every process of the (initialized) process group its own shard of the images,
+        through a ResumableSampler. See set_epoch.
 
     Returns:
     dataloader: the dataloader created from data_dir
@@ -26,7 +38,55 @@ def get_datloader(data_dir, image_size, batch_size, shuffle, num_workers):
                         ]
                     ))
 
+    # the sampler does the shuffling when there is one
+    sampler = None
+    if distributed or seed is not None:
+        sampler = ResumableSampler(dataset, batch_size, shuffle, seed or 0, distributed)
     dataloader = torch.utils.data.DataLoader(dataset, batch_size = batch_size, 
-                                        shuffle = shuffle, num_workers = num_workers)
+                                        shuffle = shuffle and sampler is None, sampler = sampler,
+                                        num_workers = num_workers, pin_memory = pin_memory)
     
     return dataloader
+
+class ResumableSampler(DistributedSampler):
+    """
+    A DistributedSampler which can start an epoch at any batch. The order of an epoch only depends on the
+    seed and the epoch, so an interrupted epoch is resumed by skipping the indices of the batches already
+    trained on, without loading them. Without distributed, it samples all the images.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle = True, seed = 0, distributed = False) -> None:
+        num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if distributed else (1, 0)
+        super().__init__(dataset, num_replicas = num_replicas, rank = rank, shuffle = shuffle, seed = seed)
+        self.batch_size = batch_size
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch = 0):
+        super().set_epoch(epoch)
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        return itertools.islice(super().__iter__(), self.start_batch * self.batch_size, None)
+
+    def __len__(self):
+        return max(0, super().__len__() - self.start_batch * self.batch_size)
+
+
+def set_epoch(dataloader, epoch, start_batch = 0):
+    """
+    Start an epoch at batch start_batch. The order of the batches of an epoch only depends on the seed
+    and the epoch, so an interrupted epoch is replayed in the same order and the batches already trained
+    on are skipped without being loaded.
+
+    Keyword arguments:
+    dataloader: a dataloader returned by get_datloader with a seed or with distributed, or by
+        shard_utils.get_shard_loader
+    epoch: the epoch about to start
+    start_batch: index of the first batch to load
+    """
+    if isinstance(dataloader.dataset, ShardDataset):
+        dataloader.dataset.set_epoch(epoch, start_batch)
+    elif isinstance(dataloader.sampler, ResumableSampler):
+        dataloader.sampler.set_epoch(epoch, start_batch)
+    else:
+        raise ValueError("Only a dataloader created with a seed or with distributed can be resumed")
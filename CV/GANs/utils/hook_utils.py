@@ -0,0 +1,196 @@
+import os
+from datetime import datetime
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+from torchvision.utils import make_grid
+
+from utils.checkpoint_utils import CheckpointManager, unwrap
+from utils.metrics_utils import AsyncLogWriter, IterationTimer, LossAccumulator
+
+
+class Hook:
+    """
+    Base class of the DCGANTrainer hooks. A hook overrides the events it is interested in,
+    every event is a no-op by default.
+    """
+
+    def on_train_start(self, trainer):
+        pass
+
+    def on_iteration_end(self, trainer, epoch, iteration, errD, errG):
+        """
+        Keyword arguments:
+        trainer: the DCGANTrainer
+        epoch: the current epoch
+        iteration: index of the batch that was just trained on, in the epoch
+        errD: the discriminator loss tensor of the batch, still on the device
+        errG: the generator loss tensor of the batch, still on the device
+        """
+        pass
+
+    def on_epoch_end(self, trainer, epoch):
+        pass
+
+    def on_train_end(self, trainer):
+        pass
+
+
+class LoggingHook(Hook):
+    """
+    Every log_every iterations, record the mean losses since the previous log into trainer.history, and
+    print them along with the iterations/sec and append them to log_file.
+
+    The losses are summed on the device and only copied to the host at the log intervals, and the log
+    file is written by a background thread, so the iterations in between never wait for the device or the disk.
+    """
+
+    def __init__(self, log_file, log_every = 50, verbose = True) -> None:
+        self.log_file = log_file
+        self.log_every = log_every
+        self.verbose = verbose
+        self.losses = None
+        self.timer = None
+        self.writer = None
+
+    def write(self, text):
+        self.writer.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S') + "\n" + text + "\n\n")
+
+    def on_train_start(self, trainer):
+        self.losses = LossAccumulator(["G", "D"], trainer.device)
+        self.timer = IterationTimer()
+        self.writer = AsyncLogWriter(self.log_file)
+        self.write("Starting operation")
+
+    def on_iteration_end(self, trainer, epoch, iteration, errD, errG):
+        self.losses.add(errG, errD)
+        self.timer.step()
+        if iteration % self.log_every != 0:
+            return
+
+        losses = self.losses.compute()
+        trainer.history["G_losses"].append(losses["G"])
+        trainer.history["D_losses"].append(losses["D"])
+
+        log_text = ("Epoch {cur_epch}/{epc}, Iteration: {cur_itr}/{itrs} \tLoss_G: {lg:.4f}\tLoss_D: {ld:.4f}"
+            "\t{its:.2f} it/s".format(cur_epch=epoch+1, epc=trainer.config.num_epochs, cur_itr=iteration+1,
+            itrs=trainer.batches_per_epoch, lg=losses["G"], ld=losses["D"], its=self.timer.rate()))
+        if self.verbose:
+            print (log_text)
+        self.write(log_text)
+
+    def on_train_end(self, trainer):
+        self.write("Ending operation")
+        self.writer.close()
+
+
+class SamplingHook(Hook):
+    """
+    Generate images from the fixed noise every sample_every iterations, the first 8 of them
+    are kept in trainer.history.
+    """
+
+    def __init__(self, sample_every = 500) -> None:
+        self.sample_every = sample_every
+
+    def on_iteration_end(self, trainer, epoch, iteration, errD, errG):
+        if iteration % self.sample_every == 0:
+            trainer.history["gen_images"].append(trainer.sample()[0:8])
+
+
+class CheckpointHook(Hook):
+    """
+    Checkpoint the trainer in the background at the end of every epoch and every checkpoint_every
+    iterations, resume from a checkpoint before training if resume is set, and save the final
+    networks to out_dir once training is done.
+
+    In distributed training, every process resumes from the checkpoint but only one of them saves.
+    """
+
+    def __init__(self, directory, out_dir = ".", checkpoint_every = None, keep_last = 3, resume = None,
+        save = True) -> None:
+        """
+        Keyword Arguments:
+        directory: the directory of the checkpoints
+        out_dir: where netD_final.pt and netG_final.pt are saved
+        checkpoint_every: also checkpoint every this many iterations, if set
+        keep_last: number of checkpoints kept on disk
+        resume: path of the checkpoint to resume from, "latest" for the latest one in directory
+        save: whether to save checkpoints and the final networks, or only to resume
+        """
+        self.manager = CheckpointManager(directory, keep_last = keep_last)
+        self.out_dir = out_dir
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        self.save = save
+
+    def on_train_start(self, trainer):
+        if self.resume:
+            checkpoint = self.manager.load(None if self.resume == "latest" else self.resume)
+            if checkpoint is not None:
+                trainer.load_state_dict(checkpoint)
+
+    def on_iteration_end(self, trainer, epoch, iteration, errD, errG):
+        if self.save and self.checkpoint_every and (iteration + 1) % self.checkpoint_every == 0:
+            self.manager.save(trainer.state_dict(), trainer.global_iteration())
+
+    def on_epoch_end(self, trainer, epoch):
+        if self.save:
+            self.manager.save(trainer.state_dict(), trainer.global_iteration())
+
+    def on_train_end(self, trainer):
+        self.manager.close()
+        if self.save:
+            torch.save(unwrap(trainer.netD).state_dict(), os.path.join(self.out_dir, "netD_final.pt"))
+            torch.save(unwrap(trainer.netG).state_dict(), os.path.join(self.out_dir, "netG_final.pt"))
+
+
+class PlotHook(Hook):
+    """
+    Once training is done, plot the losses recorded by LoggingHook and save the images generated by SamplingHook.
+    """
+
+    def __init__(self, out_dir = ".") -> None:
+        self.out_dir = out_dir
+
+    def on_train_end(self, trainer):
+        G_losses, D_losses = trainer.history["G_losses"], trainer.history["D_losses"]
+        gen_image_list = trainer.history["gen_images"]
+        total_iters = trainer.config.num_epochs * trainer.batches_per_epoch
+
+        # plot the losses over iterations
+        iters = np.linspace(0, total_iters, len(G_losses))
+
+        f = plt.figure()
+        f.set_figwidth(8)
+        f.set_figheight(8)
+        plt.plot(iters, G_losses, color="red", label="G_loss")
+        plt.plot(iters, D_losses, color="yellow", label="D_loss")
+        plt.title("Losses vs Iterations")
+        plt.ylabel("Loss")
+        plt.xlabel("Iteration")
+        plt.legend()
+        plt.savefig(os.path.join(self.out_dir, "loss_iter.png"))
+
+        if not gen_image_list:
+            return
+
+        # save generated images after 500 iterations to disk
+        gen_image_tensor = torch.cat(gen_image_list, 0)
+        grid = make_grid(gen_image_tensor.detach().cpu().clone(), padding = 5, normalize=True)
+        f = plt.figure(clear=True)
+        plt.imshow(grid.permute(1,2,0))
+        plt.axis("off")
+        plt.savefig(os.path.join(self.out_dir, "generated_images.png"))
+
+        # save last batch of generated images to disk
+        f = plt.figure(clear=True)
+        grid = make_grid(gen_image_list[len(gen_image_list)-1].detach().cpu().clone(),
+            padding = 5, normalize=True)
+        plt.imshow(grid.permute(1,2,0))
+        plt.axis("off")
+        plt.savefig(os.path.join(self.out_dir, "last_generated.png"))
+        plt.close("all")
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class LossAccumulator:
+    """
+    Sums loss tensors on their device between two log intervals.
+
+    Calling .item() on a loss waits for the device to finish the iteration. add only queues an
+    addition, the values are copied to the host once per interval, by compute.
+    """
+
+    def __init__(self, names, device) -> None:
+        """
+        Keyword Arguments:
+        names: names of the losses, in the order they are passed to add
+        device: the device of the losses
+        """
+        self.names = list(names)
+        self.sums = torch.zeros(len(self.names), device = device)
+        self.count = 0
+
+    def add(self, *losses):
+        self.sums += torch.stack([loss.detach() for loss in losses])
+        self.count += 1
+
+    def compute(self):
+        """
+        Mean of every loss since the last call, then start over.
+
+        Returns:
+        a dict of name -> mean, empty if nothing was added
+        """
+        if self.count == 0:
+            return {}
+        means = (self.sums / self.count).tolist()
+        self.sums.zero_()
+        self.count = 0
+        return dict(zip(self.names, means))
+
+
+class IterationTimer:
+    """
+    Iterations/sec over the interval since the previous call of rate.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.count = 0
+
+    def step(self):
+        self.count += 1
+
+    def rate(self):
+        now = time.perf_counter()
+        rate = self.count / max(now - self.start, 1e-9)
+        self.start, self.count = now, 0
+        return rate
+
+
+class AsyncLogWriter:
+    """
+    Appends lines to a log file from a background thread, so that training never waits for the disk.
+    The file is kept open and flushed after every batch of lines.
+    """
+
+    def __init__(self, log_file) -> None:
+        self.lines = queue.Queue()
+        self.file = open(log_file, "a")
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                break
+            self.file.write(line)
+            # write whatever else is waiting before flushing
+            while not self.lines.empty():
+                line = self.lines.get()
+                if line is None:
+                    self.file.flush()
+                    return
+                self.file.write(line)
+            self.file.flush()
+
+    def write(self, text):
+        self.lines.put(text)
+
+    def close(self):
+        """Write the pending lines and close the file"""
+        self.lines.put(None)
+        self.thread.join()
+        self.file.close()
@@ -0,0 +1,302 @@
+import argparse
+import copy
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+import torchvision.ops as tvo
+
+import neural_net
+import utils
+
+
+def measure_latency(net, batch_size = 1, img_size = 416, runs = 20, warmup = 3):
+    """
+    Measure the latency of a forward pass of the network on random input.
+    @returns: the average latency per image, in milliseconds
+    """
+    input = torch.rand(batch_size, 3, img_size, img_size)
+    with torch.no_grad():
+        for _ in range(warmup):
+            net(input)
+
+        start_time = time.perf_counter()
+        for _ in range(runs):
+            net(input)
+        elapsed = time.perf_counter() - start_time
+
+    return elapsed * 1000 / (runs * batch_size)
+
+def load_network(args):
+    """
+    Create the network from the cfg and load the weights, if any were given.
+    """
+    net = neural_net.Yolo3(args.cfg)
+    if args.weights:
+        net.load_weights(args.weights)
+    net.eval()
+    return net
+
+def benchmark_fuse(args):
+    """
+    Compare the latency of the network before and after folding the batch norm layers,
+    and check that the outputs stay the same.
+    """
+    net = load_network(args)
+    variants = [
+        ("unfused", net),
+        ("fused", copy.deepcopy(net).fuse()),
+        ("fused, channels last", copy.deepcopy(net).fuse(channels_last = True))]
+
+    input = torch.rand(1, 3, args.img_size, args.img_size)
+    with torch.no_grad():
+        reference = net(input)
+
+    for name, variant in variants:
+        with torch.no_grad():
+            max_diff = (variant(input) - reference).abs().max().item()
+        latency = measure_latency(variant, args.batch_size, args.img_size, args.runs)
+        print("{:<22} {:8.1f} ms/image   max abs diff: {:.2e}".format(name, latency, max_diff))
+
+def benchmark_loader(args):
+    """
+    Measure the throughput of the dataloader alone, without running the network.
+    """
+    loader = utils.get_dataloader(args.images, shuffle = True, batch_size = args.batch_size,
+        num_workers = args.workers, prefetch_factor = args.prefetch_factor,
+        persistent_workers = args.persistent_workers, pin_memory = args.pin_memory, fast_decode = args.fast_decode,
+        cache_dir = args.cache_dir)
+
+    num_images = 0
+    start_time = time.perf_counter()
+    for epoch in range(args.epochs):
+        for features in loader:
+            num_images += len(features)
+    elapsed = time.perf_counter() - start_time
+
+    print("Loaded {} images in {:.1f}s ({:.1f} images/sec)".format(num_images, elapsed, num_images / elapsed))
+
+def individual_loss(predicted_tensor, target_tensor):
+    """
+    The per-image loss that calculate_loss was built on before it was vectorized, kept as it was as the
+    reference of benchmark_loss.
+    @param predicted_tensor: the [N, 85] predictions for the image
+    @param target_tensor: the [n, 5] targets of the image, each row being class, x_center, y_center, width, height.
+    """
+    predicted_tensor_box = predicted_tensor[:, 0:4] / 416 # the predicted_tensor has already been scaled to actual dimensions
+    target_tensor_box = target_tensor[:, 1:5]
+    iou_tensor = tvo.box_iou(target_tensor_box, predicted_tensor_box)
+
+    _, best_indices = torch.max(iou_tensor, 1)
+    predicted_gt_boxes = predicted_tensor_box[best_indices]
+
+    predicted_gt_boxes = predicted_gt_boxes.float()
+    target_tensor_box = target_tensor_box.float()
+    coord_loss = nn.BCELoss(reduction="sum")(predicted_gt_boxes[0:2], target_tensor_box[0:2]) + \
+        nn.MSELoss(reduction="sum")(predicted_gt_boxes[2:4], target_tensor_box[2:4])
+
+    predictedgt_cls_tensor, _ = torch.max(predicted_tensor[best_indices, 5:], 1)
+    class_loss = nn.BCEWithLogitsLoss(reduction="sum")(predictedgt_cls_tensor, target_tensor[:, 0])
+
+    prediction_gt_iou_tensor, _ = torch.max(iou_tensor, 0)
+    prediction_gt_iou_tensor = prediction_gt_iou_tensor.float()
+    conf_loss = nn.BCELoss(reduction="sum")(prediction_gt_iou_tensor, predicted_tensor[:, 5])
+
+    return coord_loss + class_loss + conf_loss
+
+def reference_loss(predicted_tensor, targets):
+    """
+    The image by image loop of the previous calculate_loss, with its accumulation fixed: it used
+    "total_loss =+ loss", so only the last image counted. Images without targets are skipped,
+    individual_loss fails on them.
+    """
+    total_loss = 0
+    for i in range(len(predicted_tensor)):
+        image_targets = targets[targets[:, 0] == i, 1:]
+        if len(image_targets) > 0:
+            total_loss += individual_loss(predicted_tensor[i], image_targets)
+    return total_loss/len(predicted_tensor)
+
+def benchmark_loss(args):
+    """
+    Time a training step's loss computation (forward of the loss and backward) of the vectorized calculate_loss,
+    against the image by image loss it replaced (reference_loss).
+    """
+    net = neural_net.Yolo3(args.cfg)
+    heads = net.yolo_heads()
+    input_shape = (args.img_size, args.img_size)
+    with torch.no_grad():
+        detections = net(torch.rand(args.batch_size, 3, args.img_size, args.img_size))
+
+    # random targets, a few per image, with some images without any target
+    targets = []
+    for image_idx in range(args.batch_size):
+        num_targets = image_idx % (args.targets + 1)
+        boxes = torch.rand(num_targets, 4) * torch.tensor([1, 1, 0.5, 0.5])
+        targets.append(torch.cat((torch.full((num_targets, 1), float(image_idx)),
+            torch.randint(0, 80, (num_targets, 1)).float(), boxes), 1))
+    targets = torch.cat(targets)
+    # the reference loss applies a BCE to the boxes divided by 416, they have to stay in [0, 1]
+    reference_detections = detections.clone()
+    reference_detections[..., :4].clamp_(0, 416)
+
+    def batched_step():
+        predictions = detections.clone().requires_grad_()
+        utils.calculate_loss(predictions, targets, heads, input_shape).backward()
+
+    def reference_step():
+        predictions = reference_detections.clone().requires_grad_()
+        reference_loss(predictions, targets).backward()
+
+    for name, step in [("reference", reference_step), ("batched", batched_step)]:
+        step()
+        start_time = time.perf_counter()
+        for _ in range(args.runs):
+            step()
+        elapsed = time.perf_counter() - start_time
+        print("{:<10} {:8.2f} ms/step".format(name, elapsed * 1000 / args.runs))
+
+def box_agreement(reference, detections, iou_thres = 0.5):
+    """
+    Fraction of the reference boxes for which detections contain a box of the same class with an
+    IoU of at least iou_thres. Both are lists of [M, 7] tensors as returned by analyze_batch_detections.
+    """
+    num_matched = 0
+    num_reference = 0
+    for reference_boxes, boxes in zip(reference, detections):
+        num_reference += len(reference_boxes)
+        if len(reference_boxes) == 0 or len(boxes) == 0:
+            continue
+        iou = tvo.box_iou(reference_boxes[:, :4], boxes[:, :4])
+        same_class = reference_boxes[:, 6].unsqueeze(1) == boxes[:, 6].unsqueeze(0)
+        num_matched += ((iou >= iou_thres) & same_class).any(1).sum().item()
+    return num_matched / max(num_reference, 1)
+
+def model_size_mb(net):
+    """
+    Size of the serialized state_dict of the network, in MB.
+    """
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / (1024 * 1024)
+
+def benchmark_precision(args):
+    """
+    Compare fp32, bf16 and int8 inference: latency, peak RSS, model size, and how many of the fp32 boxes
+    are found again at reduced precision on the images of a folder.
+
+    Every precision runs in a process of its own, so that its peak RSS isn't hidden by the others.
+    The fp32 run saves its boxes, the other runs compare theirs against them.
+    """
+    if args.variant is not None:
+        run_precision(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference_file = os.path.join(tmp_dir, "fp32_detections.pt")
+        for precision in neural_net.PRECISIONS:
+            command = [sys.executable, os.path.abspath(__file__), "--cfg", args.cfg, "--img-size", str(args.img_size),
+                "--batch-size", str(args.batch_size), "--runs", str(args.runs)]
+            if args.weights:
+                command += ["--weights", args.weights]
+            command += ["precision", args.images, "--calibration-batches", str(args.calibration_batches),
+                "--variant", precision, "--reference", reference_file]
+            subprocess.run(command, check = True)
+
+def run_precision(args):
+    """
+    The precision benchmark of a single precision, args.variant, in the current process.
+    """
+    loader = utils.get_dataloader(args.images, batch_size = args.batch_size)
+    net = load_network(args).fuse().set_precision(args.variant, loader, args.calibration_batches)
+
+    detections = []
+    with torch.no_grad():
+        for features in loader:
+            detections.extend(neural_net.analyze_batch_detections(net(features)))
+    if args.variant == "fp32":
+        torch.save(detections, args.reference)
+    reference = torch.load(args.reference)
+
+    latency = measure_latency(net, args.batch_size, args.img_size, args.runs)
+    print("{:<5} {:8.1f} ms/image   peak RSS: {:6.0f} MB   model size: {:6.1f} MB   box agreement with fp32: {:.1%}".format(
+        args.variant, latency, utils.get_peak_rss_mb(), model_size_mb(net), box_agreement(reference, detections)),
+        flush = True)
+
+def benchmark_scaling(args):
+    """
+    Throughput of distributed training with an increasing number of processes on this host, and the
+    scaling efficiency compared to a single process. Every run trains for a fixed number of steps.
+    """
+    cores = os.cpu_count() or 1
+    results = []
+    for nprocs in args.procs:
+        command = [sys.executable, "train.py", "--train-images", args.images, "--train-labels", args.labels,
+            "--cfg", args.cfg, "--img-size", str(args.img_size),
+            "--batch-size", str(args.batch_size), "--epochs", "1", "--max-steps", str(args.steps),
+            "--nprocs", str(nprocs), "--threads", str(max(1, cores // nprocs))]
+        if args.weights:
+            command += ["--weights", args.weights]
+        output = subprocess.run(command, capture_output = True, text = True, check = True).stdout
+        throughput = float(re.search(r"Throughput: ([0-9.]+)", output).group(1))
+        results.append((nprocs, throughput))
+
+    base = results[0][1] / results[0][0]
+    print("{:>9} {:>12} {:>11}".format("processes", "images/sec", "efficiency"))
+    for nprocs, throughput in results:
+        print("{:>9} {:>12.2f} {:>11.1%}".format(nprocs, throughput, throughput / (base * nprocs)))
+
+def main():
+    parser = argparse.ArgumentParser(description = "CPU benchmarks for the yolo network.")
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--weights", help = "weights to load. The network is randomly initialized if omitted")
+    parser.add_argument("--img-size", type = int, default = utils.IMAGE_SIZE, help = "height and width of the input, a multiple of 32")
+    parser.add_argument("--batch-size", type = int, default = 1)
+    parser.add_argument("--runs", type = int, default = 20, help = "number of timed iterations")
+    subparsers = parser.add_subparsers(dest = "benchmark", required = True)
+
+    subparsers.add_parser("fuse", help = "latency with and without conv + batch norm fusion").set_defaults(func = benchmark_fuse)
+
+    precision_parser = subparsers.add_parser("precision", help = "latency and accuracy delta of bf16 and int8 inference")
+    precision_parser.add_argument("images", help = "folder of images used for calibration and the accuracy delta")
+    precision_parser.add_argument("--calibration-batches", type = int, default = 10)
+    # used by the processes benchmarking a single precision
+    precision_parser.add_argument("--variant", choices = neural_net.PRECISIONS, help = argparse.SUPPRESS)
+    precision_parser.add_argument("--reference", help = argparse.SUPPRESS)
+    precision_parser.set_defaults(func = benchmark_precision)
+
+    loss_parser = subparsers.add_parser("loss", help = "time per step of the loss, batched vs image by image")
+    loss_parser.add_argument("--targets", type = int, default = 10, help = "max targets per image")
+    loss_parser.set_defaults(func = benchmark_loss)
+
+    loader_parser = subparsers.add_parser("loader", help = "images/sec of the dataloader alone")
+    loader_parser.add_argument("images", help = "the folder containing the images")
+    loader_parser.add_argument("--workers", type = int, default = 0)
+    loader_parser.add_argument("--prefetch-factor", type = int, default = 2)
+    loader_parser.add_argument("--persistent-workers", action = "store_true")
+    loader_parser.add_argument("--pin-memory", action = "store_true")
+    loader_parser.add_argument("--fast-decode", action = "store_true")
+    loader_parser.add_argument("--cache-dir", help = "read the images from a preprocessed cache in this directory")
+    loader_parser.add_argument("--epochs", type = int, default = 1)
+    loader_parser.set_defaults(func = benchmark_loader)
+
+    scaling_parser = subparsers.add_parser("scaling", help = "images/sec of distributed training vs number of processes")
+    scaling_parser.add_argument("images", help = "folder of training images")
+    scaling_parser.add_argument("labels", help = "folder of training labels")
+    scaling_parser.add_argument("--procs", type = int, nargs = "+", default = [1, 2, 4, 8])
+    scaling_parser.add_argument("--steps", type = int, default = 5, help = "optimizer steps per run")
+    scaling_parser.set_defaults(func = benchmark_scaling)
+
+    args = parser.parse_args()
+    utils.set_image_size(args.img_size)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
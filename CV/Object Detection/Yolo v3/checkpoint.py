@@ -0,0 +1,113 @@
+import copy
+import glob
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def to_cpu(state):
+    """
+    Copy a (nested) training state to cpu memory, so that training can go on modifying the
+    parameters and the optimizer state while the copy is written to disk.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy = True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return copy.deepcopy(state)
+
+def get_rng_state():
+    """
+    The state of all the random number generators used during training.
+    """
+    # the numpy state holds its keys as a tensor, so that torch.load can read the checkpoint with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    numpy_state = (name, torch.from_numpy(keys.astype(np.int64)), int(pos), int(has_gauss), float(cached_gaussian))
+    state = {"python": random.getstate(), "numpy": numpy_state, "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager:
+    """
+    Writes training checkpoints in a background thread. save takes a snapshot of the state in cpu memory
+    and returns, the snapshot is written to a temporary file which is then renamed, so that a checkpoint
+    on disk is always complete even if the job is killed while writing. Only the last keep_last
+    checkpoints are kept.
+
+    At most one checkpoint is written at a time, save waits for the previous write to finish. This bounds
+    the memory to two snapshots.
+    """
+    def __init__(self, directory, prefix = "checkpoint", keep_last = 3) -> None:
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = None
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, step):
+        return os.path.join(self.directory, "{}_{:09d}.pt".format(self.prefix, step))
+
+    def checkpoints(self):
+        """
+        Paths of the checkpoints on disk, oldest first.
+        """
+        return sorted(glob.glob(os.path.join(self.directory, self.prefix + "_*.pt")))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, state, step):
+        """
+        Snapshot the state and write it asynchronously.
+        @param state: a (nested) dict of tensors, state_dicts and picklable values
+        @param step: the global step of the checkpoint, it orders the checkpoints
+        """
+        snapshot = to_cpu(state)
+        self.wait()
+        self.pending = self.executor.submit(self._write, snapshot, self.path(step))
+
+    def _write(self, snapshot, path):
+        tmp_path = path + ".tmp"
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+
+    def wait(self):
+        """
+        Wait for the checkpoint being written, and raise its error if writing failed.
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def load(self, path = None):
+        """
+        Load a checkpoint on the cpu, the latest one if path is None.
+        @returns state: the saved state, None if there is no checkpoint
+        """
+        path = path or self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location = "cpu")
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait = True)
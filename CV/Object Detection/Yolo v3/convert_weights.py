@@ -0,0 +1,32 @@
+import argparse
+import time
+
+import neural_net
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load yolo weights, report the cold start time and peak memory, "
+        "and optionally convert them into a native pytorch cache.")
+    parser.add_argument("weights", help = "darknet weights file, or a .pt cache written by this script")
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--cache", help = "write the loaded weights to this .pt file")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    net = neural_net.Yolo3(args.cfg)
+    build_time = time.perf_counter() - start_time
+
+    net.load_weights(args.weights)
+    load_time = time.perf_counter() - start_time - build_time
+
+    print("Network built in {:.2f}s, weights loaded from {} in {:.2f}s".format(build_time, args.weights, load_time))
+    print("Peak RSS: {:.0f} MB".format(utils.get_peak_rss_mb()))
+
+    if args.cache:
+        net.save_weights_cache(args.cache)
+        print("Weights cached to {}".format(args.cache))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,385 @@
+import json
+import math
 import os
+import re
+import time
 
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 from PIL import Image
 
+# color of the padding added around letterboxed images
+PAD_COLOR = (128, 128, 128)
+
+def letterbox_params(original_size, shape, letterbox = True):
+    """
+    Geometry of resizing an image to the network input.
+    @param original_size: (width, height) of the image
+    @param shape: (height, width) of the network input
+    @param letterbox: keep the aspect ratio and pad the image (True), or stretch it to shape (False)
+    @returns: (new_width, new_height, pad_x, pad_y), the size the image is resized to and the
+        position at which it is pasted in the network input
+    """
+    width, height = original_size
+    input_h, input_w = shape
+    if not letterbox:
+        return input_w, input_h, 0, 0
+
+    scale = min(input_w / width, input_h / height)
+    new_w, new_h = max(1, round(width * scale)), max(1, round(height * scale))
+    return new_w, new_h, (input_w - new_w) // 2, (input_h - new_h) // 2
+
+def resize_image(image, shape, letterbox = True, original_size = None):
+    """
+    Resize a PIL image to shape (height, width), either letterboxed or stretched.
+    @param original_size: (width, height) of the image in the file, if it was decoded at a lower
+        resolution (see ObjectDataSet._load_image)
+    """
+    new_w, new_h, pad_x, pad_y = letterbox_params(original_size or image.size, shape, letterbox)
+    image = image.resize((new_w, new_h), Image.BILINEAR)
+    if (new_h, new_w) == tuple(shape):
+        return image
+
+    canvas = Image.new("RGB", (shape[1], shape[0]), PAD_COLOR)
+    canvas.paste(image, (pad_x, pad_y))
+    return canvas
+
+def map_targets(targets, original_size, shape, letterbox = True):
+    """
+    Map the [n, 5] targets of an image (class, x_center, y_center, width, height relative to the image)
+    to coordinates relative to the network input the image was resized to.
+    """
+    new_w, new_h, pad_x, pad_y = letterbox_params(original_size, shape, letterbox)
+    input_h, input_w = shape
+
+    targets = targets.clone()
+    targets[:, 1] = (targets[:, 1] * new_w + pad_x) / input_w
+    targets[:, 2] = (targets[:, 2] * new_h + pad_y) / input_h
+    targets[:, 3] = targets[:, 3] * new_w / input_w
+    targets[:, 4] = targets[:, 4] * new_h / input_h
+    return targets
+
+def get_batch_shapes(image_sizes, img_size, batch_size, stride = 32):
+    """
+    Input shapes for batches of images sorted by aspect ratio. Every batch gets the smallest 
+    (height, width), multiple of stride, which fits all its images once they are letterboxed
+    with their longest side being img_size. This minimizes the padding.
+    @param image_sizes: (width, height) of the images, sorted by aspect ratio
+    @returns: a list of (height, width), one per batch
+    """
+    batch_shapes = []
+    for start in range(0, len(image_sizes), batch_size):
+        ratios = [height / width for width, height in image_sizes[start:start + batch_size]]
+        # landscape batch: the width is img_size. portrait batch: the height is img_size
+        if max(ratios) < 1:
+            shape = (max(ratios), 1)
+        elif min(ratios) > 1:
+            shape = (1, 1 / min(ratios))
+        else:
+            shape = (1, 1)
+        batch_shapes.append(tuple(int(math.ceil(side * img_size / stride) * stride) for side in shape))
+    return batch_shapes
+
+class ImageCache:
+    """
+    An on-disk cache of decoded and resized images, so that each image is decoded only once.
+
+    All the images are stored in a single uint8 array of shape [N, height, width, 3], which is 
+    memory mapped when read. An index next to it records the transform the cache was built with, 
+    and the name, modification time and original size of every source image. Images which changed
+    since the cache was built are decoded again; everything is rebuilt if the transform or the list
+    of images changed.
+    """
+    def __init__(self, cache_dir, image_folder, image_names, image_size = (416, 416), letterbox = True) -> None:
+        """
+        @param cache_dir: directory holding the cache, created if required
+        @param image_folder: the image folder in which all the images reside
+        @param image_names: names of the images in image_folder, in dataset order
+        @param image_size: (width, height) the images are resized to
+        @param letterbox: letterbox the images instead of stretching them
+        """
+        self.image_folder = image_folder
+        self.image_names = image_names
+        self.width, self.height = image_size
+        self.letterbox = letterbox
+        # (width, height) of every source image, required to map labels and detections
+        self.original_sizes = None
+        self.array_path = os.path.join(cache_dir, "images.u8")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok = True)
+
+        # opened lazily, so that every dataloader worker maps the file itself
+        self._images = None
+        self.hits = 0
+        self.misses = 0
+        self.build_time = 0.0
+        self._update()
+
+    def transform_key(self):
+        return "rgb, {} {}x{} bilinear".format("letterbox" if self.letterbox else "resize", self.width, self.height)
+
+    def _update(self):
+        """
+        Check the index against the source images, and decode the missing/stale ones.
+        """
+        mtimes = [os.path.getmtime(os.path.join(self.image_folder, name)) for name in self.image_names]
+        shape = (len(self.image_names), self.height, self.width, 3)
+
+        index = None
+        if os.path.exists(self.index_path) and os.path.exists(self.array_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+
+        if index is not None and index["transform"] == self.transform_key() and index["names"] == self.image_names:
+            stale = [i for i, (cached, current) in enumerate(zip(index["mtimes"], mtimes)) if cached != current]
+            self.original_sizes = [tuple(size) for size in index["sizes"]]
+            mode = "r+"
+        else:
+            stale = list(range(len(self.image_names)))
+            self.original_sizes = [None] * len(self.image_names)
+            mode = "w+"
+
+        self.hits = len(self.image_names) - len(stale)
+        self.misses = len(stale)
+        if not stale:
+            return
+
+        start_time = time.perf_counter()
+        images = np.memmap(self.array_path, dtype = np.uint8, mode = mode, shape = shape)
+        for i in stale:
+            image = Image.open(os.path.join(self.image_folder, self.image_names[i])).convert("RGB")
+            self.original_sizes[i] = image.size
+            images[i] = np.asarray(resize_image(image, (self.height, self.width), self.letterbox))
+        images.flush()
+        del images
+
+        # write the index last and atomically, an interrupted build is simply redone
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"transform": self.transform_key(), "names": self.image_names, "mtimes": mtimes,
+                "sizes": self.original_sizes}, f)
+        os.replace(tmp_path, self.index_path)
+        self.build_time = time.perf_counter() - start_time
+
+    def stats(self):
+        return "Image cache: {} images reused, {} decoded in {:.1f}s".format(self.hits, self.misses, self.build_time)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __getitem__(self, idx):
+        """
+        Returns the image as a float tensor of shape [3, height, width] with values from 0 to 1, 
+        the same as transforms.ToTensor would.
+        """
+        if self._images is None:
+            # copy on write mode, so that torch gets a writable array without anything being copied
+            self._images = np.memmap(self.array_path, dtype = np.uint8, mode = "c",
+                shape = (len(self.image_names), self.height, self.width, 3))
+        image = torch.from_numpy(self._images[idx])
+        return image.permute(2, 0, 1).float().div_(255)
+
+class LabelStore:
+    """
+    The labels of all the images, parsed once.
+
+    The targets of all the images are stored in one float32 array of shape [num_targets, 5], each row
+    being class, x_center, y_center, width, height. The rows of image i are targets[offsets[i]:offsets[i + 1]].
+    The store can be persisted to a .npz file, which is reused as long as the label files don't change.
+    """
+    def __init__(self, label_folder, image_names, store_file = None) -> None:
+        """
+        @param label_folder: the label folder in which all the labels reside
+        @param image_names: names of the images, in dataset order
+        @param store_file: optional .npz file to load the store from / save it to
+        """
+        label_paths = [os.path.join(label_folder, os.path.splitext(name)[0] + ".txt") for name in image_names]
+        mtimes = np.array([os.path.getmtime(path) if os.path.exists(path) else 0 for path in label_paths])
+        names = np.array(image_names)
+
+        if store_file is not None and os.path.exists(store_file):
+            with np.load(store_file) as store:
+                if np.array_equal(store["names"], names) and np.array_equal(store["mtimes"], mtimes):
+                    self.targets = store["targets"]
+                    self.offsets = store["offsets"]
+                    return
+
+        image_targets = [self.parse_label_file(path) for path in label_paths]
+        self.targets = np.concatenate(image_targets) if image_targets else np.zeros((0, 5), dtype = np.float32)
+        self.offsets = np.zeros(len(image_targets) + 1, dtype = np.int64)
+        np.cumsum([len(targets) for targets in image_targets], out = self.offsets[1:])
+
+        if store_file is not None:
+            np.savez(store_file, targets = self.targets, offsets = self.offsets, names = names, mtimes = mtimes)
+
+    @staticmethod
+    def parse_label_file(label_path):
+        """
+        Returns the targets of one label file as a [n, 5] float32 array. Missing or empty files have no targets.
+        """
+        if not os.path.exists(label_path):
+            return np.zeros((0, 5), dtype = np.float32)
+        with open(label_path) as f:
+            return np.array(f.read().split(), dtype = np.float32).reshape(-1, 5)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.targets[self.offsets[idx]:self.offsets[idx + 1]])
+
+def read_frames(source):
+    """
+    Iterate over the frames of a video file or of a directory of numbered frames (frame_1.jpg, frame_2.jpg,
+    ... ordered by the last number in their name). Frames are only decoded on demand, so that frames
+    skipped by the consumer cost as little as possible. Video files require opencv (cv2).
+
+    @param source: path of the video file or of the directory
+    @returns: a generator of (frame_index, load) pairs, load() decoding the frame into an RGB PIL image.
+        load has to be called before moving on to the next frame.
+    """
+    if os.path.isdir(source):
+        def frame_number(name):
+            numbers = re.findall(r"\d+", name)
+            return (int(numbers[-1]) if numbers else -1, name)
+
+        names = sorted((f for f in os.listdir(source) if f.endswith(('.jpg', '.jpeg', 'png'))), key = frame_number)
+        for index, name in enumerate(names):
+            path = os.path.join(source, name)
+            yield index, lambda path = path: Image.open(path).convert("RGB")
+        return
+
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("Reading video files requires opencv (pip install opencv-python)")
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError("Can't open the video {}".format(source))
+    try:
+        index = 0
+        # grab moves to the next frame, retrieve only converts it to an image when it is needed
+        while capture.grab():
+            yield index, lambda: Image.fromarray(cv2.cvtColor(capture.retrieve()[1], cv2.COLOR_BGR2RGB))
+            index += 1
+    finally:
+        capture.release()
+
+def collate_targets(batch):
+    """
+    The collate_fn used when the dataset returns labels. Images have the same size and are stacked,
+    but every image has its own number of targets. The targets are therefore concatenated into a 
+    single [M, 6] tensor, each row being image_idx, class, x_center, y_center, width, height.
+    Paths (if any) are returned as a list.
+    """
+    images = torch.stack([item[0] for item in batch])
+    targets = torch.cat([torch.cat((torch.full((len(item[1]), 1), float(image_idx)), item[1]), 1)
+        for image_idx, item in enumerate(batch)])
+
+    if len(batch[0]) == 3:
+        return images, targets, [item[2] for item in batch]
+    return images, targets
+
 class ObjectDataSet(Dataset):
     """
     A custom Dataset class to read input images and (optional) labels.
+
+    If img_size is given, the images are resized (letterboxed or stretched) to img_size x img_size 
+    by the dataset before the transform is applied, and the labels are mapped accordingly. With rect,
+    the images are sorted by aspect ratio instead, and every batch of batch_size images gets its own
+    input shape with as little padding as possible.
     """
-    def __init__(self, image_folder_path, label_folder_path = None, transform = None, shuffle = False) -> None:
+    def __init__(self, image_folder_path, label_folder_path = None, transform = None, shuffle = False, return_paths = False,
+        fast_decode = False, cache_dir = None, label_store_file = None, img_size = None, letterbox = True,
+        rect = False, batch_size = 1) -> None:
         super().__init__()
         self.image_folder = image_folder_path
         self.label_folder = label_folder_path
         self.transform = transform
+        # let the JPEG decoder downscale while decoding, see _load_image
+        self.fast_decode = fast_decode
+        # also return the path of the image, so that results can be traced back to their source
+        self.return_paths = return_paths
+        self.img_size = img_size
+        self.letterbox = letterbox
         
-        self.image_objects =  [f for f in os.listdir(self.image_folder) if f.endswith(('.jpg', '.jpeg', 'png'))]
+        # sorted, so that the order doesn't depend on the file system
+        self.image_objects =  sorted(f for f in os.listdir(self.image_folder) if f.endswith(('.jpg', '.jpeg', 'png')))
+
+        self.batch_size = batch_size
+        self.batch_shapes = None
+        if rect:
+            # only the headers are read to get the sizes
+            image_sizes = [Image.open(os.path.join(self.image_folder, name)).size for name in self.image_objects]
+            order = sorted(range(len(image_sizes)), key = lambda i: image_sizes[i][1] / image_sizes[i][0])
+            self.image_objects = [self.image_objects[i] for i in order]
+            self.batch_shapes = get_batch_shapes([image_sizes[i] for i in order], img_size, batch_size)
+
         if self.label_folder is not None:
-            self.label_objects = [f for f in os.listdir(self.label_folder) if f.endswith(('.txt'))]
+            # an image without a label file is a background image, with no targets
+            self.labels = LabelStore(self.label_folder, self.image_objects, label_store_file)
+
+        # the cache replaces decoding and resizing. It holds images of a single shape.
+        self.cache = None
+        if cache_dir is not None:
+            if img_size is None or rect:
+                raise ValueError("The image cache requires a fixed img_size and can't be used with rect batches")
+            self.cache = ImageCache(cache_dir, self.image_folder, self.image_objects, (img_size, img_size), letterbox)
+            print(self.cache.stats())
+
+    def get_shape(self, idx):
+        """
+        Returns the (height, width) of the network input for image idx, None if the images aren't resized.
+        """
+        if self.batch_shapes is not None:
+            return self.batch_shapes[idx // self.batch_size]
+        if self.img_size is not None:
+            return (self.img_size, self.img_size)
+        return None
             
-    def __getitem__(self, idx):
-        image_path = os.path.join(self.image_folder, self.image_objects[idx])
+    def _load_image(self, image_path, shape):
+        """
+        Decode the image, resize it to shape and apply the transform.
+        @returns: the image and its original (width, height)
+        """
         image = Image.open(image_path)
+        original_size = image.size
+        if self.fast_decode and shape is not None:
+            # JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale, which is a lot cheaper than decoding
+            # the full image and resizing it. draft keeps the image at least as large as the input, 
+            # resize_image does the exact resize. This is a no-op for other formats.
+            image.draft("RGB", (shape[1], shape[0]))
+        image = image.convert("RGB")
+        if shape is not None:
+            image = resize_image(image, shape, self.letterbox, original_size)
         if self.transform:
             image = self.transform(image)
+        return image, original_size
+
+    def __getitem__(self, idx):
+        image_path = os.path.join(self.image_folder, self.image_objects[idx])
+        shape = self.get_shape(idx)
+        if self.cache is not None:
+            image = self.cache[idx]
+            original_size = self.cache.original_sizes[idx]
+        else:
+            image, original_size = self._load_image(image_path, shape)
 
         if self.label_folder:
-            label_path = os.path.join(self.label_folder, self.image_objects[idx].split(".")[0] + ".txt")
-            with open(label_path) as f:
-                # Don't split the target information into various lines. 
-                # Different targets files contain different number of targets. 
-                # The loader expects all targets of same size. 
-                # Targets could be split in the code downstream.
-                lines = f.read()
-            return image, lines
+            # Different images contain different number of targets, see collate_targets
+            targets = self.labels[idx]
+            if shape is not None:
+                targets = map_targets(targets, original_size, shape, self.letterbox)
+            if self.return_paths:
+                return image, targets, image_path
+            return image, targets
 
         else:
+            if self.return_paths:
+                return image, image_path
             return image
 
     def __len__(self):
-        if self.label_folder is not None:
-            assert len(self.label_objects) == len(self.image_objects)
-        
         return len(self.image_objects)
         
\ No newline at end of file
@@ -1,42 +1,204 @@
 import argparse
-import os
+import json
+import queue
+import threading
+import time
 
 import torch
+import torchvision.transforms as transforms
 
+import datasets
 import neural_net
 import utils
 
 
-def detect(image_dir_path):
-    detect_loader = utils.get_dataloader(image_dir_path, shuffle=False)
-    net = neural_net.Yolo3("assets/config.cfg")
-    net.load_weights("assets/yolov3.weights")
-    
-    net.eval()
-    dtctn_exists = False
-    for _, features in enumerate(detect_loader):
+def detect(image_dir_path, cfg_file = "assets/config.cfg", weights_file = "assets/yolov3.weights",
+    classes_file = "assets/coco.names", out_dir = "det", cnf_thres = 0.5, iou_thres = 0.4,
+    queue_size = 4, num_writers = 2, batch_size = 2, num_workers = 0, fast_decode = False, cache_dir = None,
+    letterbox = True, rect = False, precision = "fp32", tile = False, tile_overlap = 64):
+    """
+    Detect objects in every image of image_dir_path and save a copy of each image with the
+    bounding boxes drawn in out_dir.
+
+    The images are processed batch by batch as a stream: batches are loaded on a background
+    thread, go through the network and NMS, and are drawn and saved by a pool of writer threads.
+    The queues between the stages are bounded, so the memory does not grow with the dataset.
+
+    The images are resized to utils.IMAGE_SIZE, letterboxed unless letterbox is False. With rect, the
+    images are batched by aspect ratio and every batch is only padded to the next multiple of 32.
+
+    precision is one of neural_net.PRECISIONS. For int8, the first batches of image_dir_path are used to calibrate.
+
+    With tile, the images are not resized. Each one is cut into overlapping utils.IMAGE_SIZE tiles instead,
+    batch_size tiles go through the network at a time, see Yolo3.detect_tiled.
+    """
+    classes = utils.read_classes(classes_file)
+    net = neural_net.Yolo3(cfg_file)
+    net.load_weights(weights_file, fused = True)
+
+    if tile:
+        # full resolution images, decoded one at a time on a background thread. They are kept in uint8,
+        # detect_tiled converts them to float one batch of tiles at a time
+        full_images = datasets.ObjectDataSet(image_dir_path, transform = transforms.PILToTensor(), return_paths = True)
+        # tiles have the size of the network input, int8 is calibrated on the images resized to it
+        calibration_loader = None
+        if precision == "int8":
+            calibration_loader = utils.get_dataloader(image_dir_path, batch_size = batch_size, num_workers = num_workers)
+        net.set_precision(precision, calibration_loader = calibration_loader)
+    else:
+        detect_loader = utils.get_dataloader(image_dir_path, shuffle = False, return_paths = True, batch_size = batch_size,
+            num_workers = num_workers, fast_decode = fast_decode, cache_dir = cache_dir, letterbox = letterbox, rect = rect)
+        net.set_precision(precision, calibration_loader = detect_loader)
+    writer = utils.AsyncWriter(num_writers, queue_size)
+
+    num_images = 0
+    start_time = time.perf_counter()
+    if tile:
         with torch.no_grad():
-            detections = net(features)
-            if dtctn_exists:
-                detection_tensor = torch.cat((detection_tensor, detections), 0)
-            else:
-                detection_tensor = detections
-                dtctn_exists = True
-
-    images =  [f for f in os.listdir(image_dir_path) if f.endswith(('.jpg', '.jpeg', 'png'))]
-    
-    # Loop over each detection. One detection corresponds to one image
-    for det_ind in range(len(detection_tensor)):
-        det = detection_tensor[det_ind]
-        det = neural_net.analyze_detections(det, cnf_thres = 0.5, iou_thres = 0.4)
-        if isinstance(det, int):
-            continue
-        classes = utils.read_classes("assets/coco.names")
-        
-        img = os.path.join(image_dir_path, images[det_ind])
-        utils.draw_rectangle(img, det, classes)
-
-
-
-image_dir_path = "/Users/Jain/code/cloned/ultralytics/coco128/train/images/train2017"
-detect(image_dir_path)
+            for image, image_path in utils.prefetch((full_images[i] for i in range(len(full_images))), queue_size):
+                det = net.detect_tiled(image, overlap = tile_overlap, batch_size = batch_size, cnf_thres = cnf_thres,
+                    iou_thres = iou_thres)
+                # the boxes are already in pixels of the image
+                if det.size(0) != 0:
+                    writer.submit(utils.draw_rectangle, image_path, det, classes, out_dir, tuple(image.shape[1:]), False)
+                num_images += 1
+    else:
+        with torch.no_grad():
+            for features, image_paths in utils.prefetch(detect_loader, queue_size):
+                detections = neural_net.analyze_batch_detections(net(features), cnf_thres, iou_thres)
+
+                # One detection corresponds to one image
+                for image_path, det in zip(image_paths, detections):
+                    if det.size(0) != 0:
+                        writer.submit(utils.draw_rectangle, image_path, det, classes, out_dir, tuple(features.shape[2:]),
+                            letterbox)
+                num_images += len(image_paths)
+
+    writer.close()
+    elapsed = time.perf_counter() - start_time
+    print("Processed {} images in {:.1f}s ({:.2f} images/sec)".format(num_images, elapsed, num_images / elapsed))
+
+
+def write_frame_detections(output, frame_index, detections):
+    boxes = [[round(value, 2) for value in row] for row in detections.tolist()]
+    output.write(json.dumps({"frame": frame_index, "boxes": boxes}) + "\n")
+
+def detect_stream(source, cfg_file = "assets/config.cfg", weights_file = "assets/yolov3.weights",
+    out_file = "detections.jsonl", cnf_thres = 0.5, iou_thres = 0.4, batch_size = 1, queue_size = 4,
+    drop_frames = False, letterbox = True, precision = "fp32"):
+    """
+    Detect objects in the frames of a video file or of a directory of numbered frames (see datasets.read_frames).
+    The boxes of every frame are written to out_file as one JSON line, {"frame": index, "boxes": [[x1, y1, x2, y2,
+    conf, class_conf, class], ...]}, in pixels of the frame.
+
+    A producer thread decodes and resizes the frames while the network runs on the previous batch. The queue
+    between the two holds at most queue_size frames. When it is full, the producer waits, or with drop_frames
+    skips the frame without decoding it: the network then keeps up with the source at the price of dropped
+    frames. A batch takes the frames that are ready, up to batch_size, instead of waiting for more.
+    The lines are written by a background thread.
+    """
+    if precision == "int8":
+        raise ValueError("int8 requires calibration images, run detect on a folder of images instead")
+    net = neural_net.Yolo3(cfg_file)
+    net.load_weights(weights_file, fused = True)
+    net.set_precision(precision)
+
+    shape = (utils.IMAGE_SIZE, utils.IMAGE_SIZE)
+    transform = utils.get_image_transform()
+    frames = queue.Queue(maxsize = queue_size)
+    end_marker = object()
+    errors = []
+    dropped = 0
+
+    def produce():
+        nonlocal dropped
+        try:
+            for index, load in datasets.read_frames(source):
+                if drop_frames and frames.full():
+                    dropped += 1
+                    continue
+                image = load()
+                frames.put((index, image.size, transform(datasets.resize_image(image, shape, letterbox))))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            frames.put(end_marker)
+
+    # a single writer thread keeps the lines in frame order
+    writer = utils.AsyncWriter(1, queue_size)
+    num_frames = 0
+    start_time = time.perf_counter()
+    threading.Thread(target = produce, daemon = True).start()
+    with open(out_file, "w") as output, torch.no_grad():
+        done = False
+        while not done:
+            batch = [frames.get()]
+            while len(batch) < batch_size and batch[-1] is not end_marker:
+                try:
+                    batch.append(frames.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is end_marker:
+                batch.pop()
+                done = True
+            if not batch:
+                continue
+
+            indices, sizes, images = zip(*batch)
+            detections = neural_net.analyze_batch_detections(net(torch.stack(images)), cnf_thres, iou_thres)
+            for index, size, det in zip(indices, sizes, detections):
+                writer.submit(write_frame_detections, output, index, utils.unmap_boxes(det, size, shape, letterbox))
+            num_frames += len(batch)
+        writer.close()
+
+    if errors:
+        raise errors[0]
+    elapsed = time.perf_counter() - start_time
+    print("Processed {} frames in {:.1f}s ({:.2f} FPS), dropped {} frames".format(num_frames, elapsed,
+        num_frames / elapsed, dropped))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Detect objects in a folder of images using Yolo v3.")
+    parser.add_argument("images", help = "the folder containing the images, or with --stream a video file "
+        "or a folder of numbered frames")
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--weights", default = "assets/yolov3.weights", help = "darknet weights or a .pt cache")
+    parser.add_argument("--classes", default = "assets/coco.names", help = "file with the names of the classes")
+    parser.add_argument("--out-dir", default = "det", help = "where the images with boxes drawn are saved")
+    parser.add_argument("--cnf-thres", type = float, default = 0.5, help = "objectness threshold")
+    parser.add_argument("--iou-thres", type = float, default = 0.4, help = "NMS iou threshold")
+    parser.add_argument("--queue-size", type = int, default = 4, help = "max batches/images waiting between stages")
+    parser.add_argument("--writers", type = int, default = 2, help = "number of writer threads")
+    parser.add_argument("--batch-size", type = int, default = 2)
+    parser.add_argument("--workers", type = int, default = 0, help = "number of image decoding processes")
+    parser.add_argument("--fast-decode", action = "store_true", help = "downscale JPEGs while decoding them")
+    parser.add_argument("--cache-dir", help = "cache the decoded images in this directory")
+    parser.add_argument("--img-size", type = int, default = utils.IMAGE_SIZE, help = "input size, a multiple of 32")
+    parser.add_argument("--stretch", action = "store_true", help = "stretch the images instead of letterboxing them")
+    parser.add_argument("--rect", action = "store_true", help = "batch the images by aspect ratio")
+    parser.add_argument("--precision", choices = neural_net.PRECISIONS, default = "fp32", help = "inference precision")
+    parser.add_argument("--tile", action = "store_true", help = "detect on overlapping --img-size tiles of the full "
+        "resolution images, for small objects in large images")
+    parser.add_argument("--tile-overlap", type = int, default = 64, help = "min overlap of the tiles in pixels")
+    parser.add_argument("--stream", action = "store_true", help = "detect on the frames of a video, the boxes are "
+        "written to --jsonl")
+    parser.add_argument("--jsonl", default = "detections.jsonl", help = "output file of --stream")
+    parser.add_argument("--drop-frames", action = "store_true", help = "with --stream, skip frames while the "
+        "network is busy instead of waiting")
+    args = parser.parse_args()
+    if args.tile and not 0 <= args.tile_overlap < args.img_size:
+        parser.error("--tile-overlap must be at least 0 and less than --img-size")
+
+    utils.set_image_size(args.img_size)
+    if args.stream:
+        detect_stream(args.images, args.cfg, args.weights, args.jsonl, args.cnf_thres, args.iou_thres,
+            args.batch_size, args.queue_size, args.drop_frames, not args.stretch, args.precision)
+        return
+    detect(args.images, args.cfg, args.weights, args.classes, args.out_dir, args.cnf_thres, args.iou_thres,
+        args.queue_size, args.writers, args.batch_size, args.workers, args.fast_decode, args.cache_dir,
+        not args.stretch, args.rect, args.precision, args.tile, args.tile_overlap)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import time
+
+import torch
+import torch.distributed as dist
+import torchvision.ops as tvo
+
+import neural_net
+import utils
+
+# IoU thresholds of the COCO mAP@0.5:0.95, the first one gives mAP@0.5
+IOU_THRESHOLDS = torch.linspace(0.5, 0.95, 10)
+
+# recall values at which the precision is sampled for the COCO style 101 point AP
+RECALL_POINTS = torch.linspace(0, 1, 101)
+
+
+def first_occurrences(values):
+    """
+    Mask of the first occurrence of every value of a 1D tensor. The order of the tensor decides
+    which occurrence is the first one.
+    """
+    sorted_values, order = torch.sort(values, stable = True)
+    first = torch.ones_like(sorted_values, dtype = torch.bool)
+    first[1:] = sorted_values[1:] != sorted_values[:-1]
+    mask = torch.zeros_like(first)
+    mask[order[first]] = True
+    return mask
+
+def match_predictions(pred_boxes, pred_classes, pred_images, gt_boxes, gt_classes, gt_images,
+    iou_thresholds = IOU_THRESHOLDS):
+    """
+    Match the predictions of a batch to its ground truth boxes, for all the IoU thresholds at once.
+
+    For every threshold, the (prediction, ground truth) pairs of the same image and class overlapping at
+    least that much are sorted by IoU, and every prediction and every ground truth box keeps its best pair
+    only. This is the matching used by yolov5; it differs from the greedy matching of the COCO API by
+    score order in rare crowded cases only.
+
+    @param pred_boxes: [P, 4] x1, y1, x2, y2
+    @param gt_boxes: [G, 4] x1, y1, x2, y2, in the same coordinates as pred_boxes
+    @returns tp: a [P, len(iou_thresholds)] bool tensor, whether each prediction is a true positive
+    """
+    tp = torch.zeros((len(pred_boxes), len(iou_thresholds)), dtype = torch.bool)
+    if len(pred_boxes) == 0 or len(gt_boxes) == 0:
+        return tp
+
+    iou = tvo.box_iou(pred_boxes, gt_boxes)
+    same = (pred_images.unsqueeze(1) == gt_images.unsqueeze(0)) & (pred_classes.unsqueeze(1) == gt_classes.unsqueeze(0))
+    iou = torch.where(same, iou, torch.zeros_like(iou))
+
+    # candidate pairs over the lowest threshold, sorted by descending IoU
+    pred_idx, gt_idx = torch.nonzero(iou >= iou_thresholds[0], as_tuple = True)
+    pair_iou = iou[pred_idx, gt_idx]
+    order = torch.argsort(pair_iou, descending = True)
+    pred_idx, gt_idx, pair_iou = pred_idx[order], gt_idx[order], pair_iou[order]
+
+    for t, threshold in enumerate(iou_thresholds):
+        keep = pair_iou >= threshold
+        pairs_pred, pairs_gt = pred_idx[keep], gt_idx[keep]
+        best = first_occurrences(pairs_pred)
+        pairs_pred, pairs_gt = pairs_pred[best], pairs_gt[best]
+        best = first_occurrences(pairs_gt)
+        tp[pairs_pred[best], t] = True
+    return tp
+
+def average_precision(tp, num_gt):
+    """
+    COCO style 101 point interpolated AP of one class, for all the IoU thresholds at once.
+    @param tp: [P, T] true positives of the predictions of the class, sorted by descending score
+    @param num_gt: number of ground truth boxes of the class
+    @returns ap: a [T] tensor
+    """
+    if len(tp) == 0:
+        return torch.zeros(tp.size(1))
+
+    tp_count = tp.double().cumsum(0)
+    recall = (tp_count / num_gt).t().contiguous()
+    precision = (tp_count / torch.arange(1, len(tp) + 1, dtype = torch.float64).unsqueeze(1)).t()
+
+    # precision envelope: the max precision at any higher recall
+    precision = precision.flip(1).cummax(1)[0].flip(1)
+    indices = torch.searchsorted(recall, RECALL_POINTS.double().expand(len(recall), -1).contiguous())
+    # recall points that are never reached get a precision of 0
+    precision = torch.cat((precision, torch.zeros(len(precision), 1, dtype = precision.dtype)), 1)
+    return precision.gather(1, indices).mean(1).float()
+
+
+class MAPEvaluator:
+    """
+    Streaming COCO style mAP@0.5 and mAP@0.5:0.95.
+
+    Every batch is matched against its ground truth as it comes, and only compact per-prediction
+    arrays are kept (score, class and one true positive flag per IoU threshold, 16 bytes per prediction)
+    along with the number of ground truth boxes per class. The feature maps and the boxes themselves
+    are dropped, so the memory stays small even on the full COCO val set.
+    """
+    def __init__(self, num_classes, max_det = 300) -> None:
+        """
+        @param num_classes: number of classes of the network
+        @param max_det: maximum number of predictions kept per image, the highest scoring ones
+        """
+        self.num_classes = num_classes
+        self.max_det = max_det
+        self.scores = []
+        self.classes = []
+        self.tp = []
+        self.gt_count = torch.zeros(num_classes, dtype = torch.long)
+
+    def update(self, detections, image_indices, targets, input_shape):
+        """
+        Add the detections of a batch.
+        @param detections: the [M, 7] tensor returned by neural_net.batched_nms (sort_by_class can be False)
+        @param image_indices: the [M] image indexes returned by neural_net.batched_nms
+        @param targets: the [G, 6] targets of the batch, as returned by datasets.collate_targets
+        @param input_shape: (height, width) of the network input, the targets are relative to it
+        """
+        detections, image_indices, targets = detections.cpu(), image_indices.cpu(), targets.cpu()
+
+        # keep the max_det highest scoring detections of every image
+        scores = detections[:, 4] * detections[:, 5]
+        order = torch.argsort(scores, descending = True)
+        order = order[torch.sort(image_indices[order], stable = True)[1]]
+        detections, image_indices, scores = detections[order], image_indices[order], scores[order]
+        counts = torch.bincount(image_indices)
+        starts = torch.cumsum(counts, 0) - counts
+        keep = torch.arange(len(image_indices)) - starts[image_indices] < self.max_det
+        detections, image_indices, scores = detections[keep], image_indices[keep], scores[keep]
+
+        input_h, input_w = input_shape
+        scale = torch.tensor([input_w, input_h, input_w, input_h], dtype = torch.float32)
+        gt_boxes = tvo.box_convert(targets[:, 2:6], "cxcywh", "xyxy") * scale
+        gt_classes = targets[:, 1].long()
+
+        pred_classes = detections[:, 6].long()
+        tp = match_predictions(detections[:, :4], pred_classes, image_indices, gt_boxes, gt_classes,
+            targets[:, 0].long())
+
+        self.scores.append(scores.float())
+        self.classes.append(pred_classes.short())
+        self.tp.append(tp)
+        self.gt_count += torch.bincount(gt_classes, minlength = self.num_classes)
+
+    def all_gather(self):
+        """
+        In distributed evaluation, every process evaluates its own shard of the images. Collect the predictions
+        and the ground truth counts of all the processes, compute then gives the mAP of all the images.
+        """
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, (self.scores, self.classes, self.tp, self.gt_count))
+        self.scores = [scores for state in states for scores in state[0]]
+        self.classes = [classes for state in states for classes in state[1]]
+        self.tp = [tp for state in states for tp in state[2]]
+        self.gt_count = sum(state[3] for state in states)
+
+    def compute(self):
+        """
+        @returns metrics: a dict with map50, map (mAP@0.5:0.95) and ap, the [num_classes, 10] AP per class
+            and IoU threshold. Classes without ground truth are left out of the means and have an AP of -1.
+        """
+        ap = torch.full((self.num_classes, len(IOU_THRESHOLDS)), -1.0)
+        if self.scores:
+            scores, classes, tp = torch.cat(self.scores), torch.cat(self.classes).long(), torch.cat(self.tp)
+
+            # sort by class and then by descending score, every class is then a contiguous slice
+            order = torch.argsort(scores, descending = True)
+            order = order[torch.sort(classes[order], stable = True)[1]]
+            classes, tp = classes[order], tp[order]
+            ends = torch.cumsum(torch.bincount(classes, minlength = self.num_classes), 0).tolist()
+        else:
+            tp = torch.zeros((0, len(IOU_THRESHOLDS)), dtype = torch.bool)
+            ends = [0] * self.num_classes
+
+        start = 0
+        for cls, end in enumerate(ends):
+            if self.gt_count[cls] > 0:
+                ap[cls] = average_precision(tp[start:end], self.gt_count[cls].item())
+            start = end
+
+        present = self.gt_count > 0
+        mean_ap = ap[present].mean(0) if present.any() else torch.zeros(len(IOU_THRESHOLDS))
+        return {"map50": mean_ap[0].item(), "map": mean_ap.mean().item(), "ap": ap}
+
+
+def evaluate(net, loader, cnf_thres = 0.001, iou_thres = 0.6, max_det = 300, queue_size = 4):
+    """
+    Run the network over a labelled dataloader (see utils.get_dataloader) and compute its mAP.
+    The batches are loaded on a background thread while the network runs.
+    @returns metrics: see MAPEvaluator.compute
+    """
+    evaluator = MAPEvaluator(net.yolo_heads()[0].num_attrs - 5, max_det)
+    with torch.no_grad():
+        for features, targets in utils.prefetch(loader, queue_size):
+            detections, image_indices = neural_net.batched_nms(net(features), cnf_thres, iou_thres,
+                sort_by_class = False)
+            evaluator.update(detections, image_indices, targets, features.shape[2:])
+    return evaluator.compute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "COCO style mAP@0.5 and mAP@0.5:0.95 of Yolo v3 on a labelled folder of images.")
+    parser.add_argument("images", help = "the folder containing the images")
+    parser.add_argument("labels", help = "the folder containing the labels")
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--weights", default = "assets/yolov3.weights", help = "darknet weights or a .pt cache")
+    parser.add_argument("--classes", default = "assets/coco.names", help = "file with the names of the classes")
+    parser.add_argument("--cnf-thres", type = float, default = 0.001, help = "objectness threshold")
+    parser.add_argument("--iou-thres", type = float, default = 0.6, help = "NMS iou threshold")
+    parser.add_argument("--max-det", type = int, default = 300, help = "max detections per image")
+    parser.add_argument("--batch-size", type = int, default = 8)
+    parser.add_argument("--workers", type = int, default = 0, help = "number of image decoding processes")
+    parser.add_argument("--img-size", type = int, default = utils.IMAGE_SIZE, help = "input size, a multiple of 32")
+    parser.add_argument("--rect", action = "store_true", help = "batch the images by aspect ratio")
+    parser.add_argument("--precision", choices = neural_net.PRECISIONS, default = "fp32", help = "inference precision")
+    args = parser.parse_args()
+
+    utils.set_image_size(args.img_size)
+    net = neural_net.Yolo3(args.cfg)
+    net.load_weights(args.weights, fused = True)
+    net.eval()
+    loader = utils.get_dataloader(args.images, args.labels, batch_size = args.batch_size, num_workers = args.workers,
+        rect = args.rect)
+    net.set_precision(args.precision, calibration_loader = loader)
+
+    start_time = time.perf_counter()
+    metrics = evaluate(net, loader, args.cnf_thres, args.iou_thres, args.max_det)
+    elapsed = time.perf_counter() - start_time
+
+    classes = utils.read_classes(args.classes)
+    for cls, ap in enumerate(metrics["ap"]):
+        if ap[0] >= 0:
+            print("{:<20} AP@0.5: {:.3f}   AP@0.5:0.95: {:.3f}".format(classes[cls], ap[0].item(), ap.mean().item()))
+    print("mAP@0.5: {:.4f}   mAP@0.5:0.95: {:.4f}".format(metrics["map50"], metrics["map"]))
+    print("Evaluated {} images in {:.1f}s ({:.2f} images/sec)".format(len(loader.dataset), elapsed,
+        len(loader.dataset) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import time
+
+import torch
+from torch import nn as nn
+
+import neural_net
+import utils
+
+
+class ExportModel(nn.Module):
+    """
+    Wraps a Yolo3 network for tracing and export. The forward is the static execution plan compiled
+    from the cfg, with the yolo decode included and NMS optional.
+
+    Without NMS, the output is the [B, N, 85] detection tensor. With NMS, it is a single [M, 8] tensor
+    for the whole batch, each row being image_idx, bx1, by1, bx2, by2, conf, class_conf, class.
+    """
+    def __init__(self, net, nms = False, cnf_thres = 0.5, iou_thres = 0.4, top_k = 3000) -> None:
+        super().__init__()
+        self.net = net
+        self.nms = nms
+        self.cnf_thres = cnf_thres
+        self.iou_thres = iou_thres
+        self.top_k = top_k
+
+    def forward(self, input):
+        detections = self.net.run_plan(input)
+        if not self.nms:
+            return detections
+
+        result, image_indices = neural_net.batched_nms(detections, self.cnf_thres, self.iou_thres, self.top_k,
+            sort_by_class = False)
+        return torch.cat((image_indices.unsqueeze(1).to(result.dtype), result), 1)
+
+def get_example_input(batch_size = 1, img_size = None):
+    img_size = img_size or utils.IMAGE_SIZE
+    return torch.rand(batch_size, 3, img_size, img_size)
+
+def export_torchscript(net, path, nms = False, batch_size = 1, img_size = None):
+    """
+    Trace the network into TorchScript and save it to path. The traced graph is specialized for 
+    the input size, the batch size can vary.
+    @returns: the traced module
+    """
+    net.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(ExportModel(net, nms), get_example_input(batch_size, img_size), check_trace = False)
+    traced.save(path)
+    return traced
+
+def export_onnx(net, path, nms = False, batch_size = 1, img_size = None, opset_version = 11):
+    """
+    Export the network to ONNX. The batch dimension of the input is dynamic.
+    """
+    net.eval()
+    output_axes = {0: "num_detections"} if nms else {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(ExportModel(net, nms), get_example_input(batch_size, img_size), path,
+            opset_version = opset_version, input_names = ["images"], output_names = ["detections"],
+            dynamic_axes = {"images": {0: "batch"}, "detections": output_axes})
+
+def compile_model(net, nms = False, **compile_options):
+    """
+    Returns the network optimized by torch.compile (pytorch 2.0 or later).
+    """
+    if not hasattr(torch, "compile"):
+        raise RuntimeError("torch.compile requires pytorch 2.0 or later, found {}".format(torch.__version__))
+    net.eval()
+    return torch.compile(ExportModel(net, nms), **compile_options)
+
+def load_onnx(path):
+    """
+    Load an exported ONNX model in an onnxruntime CPU session.
+    @returns: a function taking and returning tensors like the eager model, None if onnxruntime isn't installed
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers = ["CPUExecutionProvider"])
+    return lambda input: torch.from_numpy(session.run(None, {"images": input.numpy()})[0])
+
+def check_parity(reference, output, atol = 1e-3):
+    """
+    Compare the output of an exported model with the output of the eager model.
+    @returns: the max absolute difference
+    """
+    if reference.shape != output.shape:
+        raise AssertionError("Shape mismatch: eager {} vs exported {}".format(tuple(reference.shape), tuple(output.shape)))
+    max_diff = (reference - output).abs().max().item() if reference.numel() else 0.0
+    if max_diff > atol:
+        raise AssertionError("Exported model differs from the eager model by {:.2e} (atol {:.0e})".format(max_diff, atol))
+    return max_diff
+
+def measure_latency(model, input, runs):
+    with torch.no_grad():
+        model(input)
+        start_time = time.perf_counter()
+        for _ in range(runs):
+            model(input)
+    return (time.perf_counter() - start_time) * 1000 / (runs * len(input))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Export the yolo network, check it against the eager model and "
+        "compare their CPU latency.")
+    parser.add_argument("format", choices = ["torchscript", "onnx", "compile"])
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--weights", default = "assets/yolov3.weights", help = "darknet weights or a .pt cache")
+    parser.add_argument("--out", help = "path of the exported model, yolov3.pt / yolov3.onnx by default")
+    parser.add_argument("--nms", action = "store_true", help = "include NMS in the exported model")
+    parser.add_argument("--fuse", action = "store_true", help = "fold batch norm into the convolutions first")
+    parser.add_argument("--img-size", type = int, default = utils.IMAGE_SIZE, help = "input size, a multiple of 32")
+    parser.add_argument("--batch-size", type = int, default = 1)
+    parser.add_argument("--runs", type = int, default = 10, help = "number of timed iterations")
+    args = parser.parse_args()
+
+    utils.set_image_size(args.img_size)
+    net = neural_net.Yolo3(args.cfg)
+    net.load_weights(args.weights, fused = args.fuse)
+    net.eval()
+
+    eager = ExportModel(net, args.nms)
+    input = get_example_input(args.batch_size)
+    with torch.no_grad():
+        reference = eager(input)
+
+    if args.format == "torchscript":
+        exported = export_torchscript(net, args.out or "yolov3.pt", args.nms, args.batch_size)
+    elif args.format == "onnx":
+        path = args.out or "yolov3.onnx"
+        export_onnx(net, path, args.nms, args.batch_size)
+        print("Exported to {}".format(path))
+        exported = load_onnx(path)
+        if exported is None:
+            print("onnxruntime is not installed, skipping the parity check and the latency comparison")
+            return
+    else:
+        exported = compile_model(net, args.nms)
+
+    with torch.no_grad():
+        output = exported(input)
+    print("Parity with the eager model: max abs diff {:.2e}".format(check_parity(reference, output)))
+    print("eager:    {:8.1f} ms/image".format(measure_latency(eager, input, args.runs)))
+    print("{:<9} {:8.1f} ms/image".format(args.format + ":", measure_latency(exported, input, args.runs)))
+
+
+if __name__ == "__main__":
+    main()
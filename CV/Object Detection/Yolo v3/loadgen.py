@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+import utils
+
+
+async def read_response(reader):
+    """
+    Read one HTTP response, returns the status code and the decoded JSON body.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("The server closed the connection")
+
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            content_length = int(value.strip())
+
+    body = await reader.readexactly(content_length)
+    return int(status_line.split()[1]), json.loads(body)
+
+async def request(host, port, method, path, body = b""):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+        .format(method, path, host, len(body)).encode("latin-1") + body)
+    await writer.drain()
+    response = await read_response(reader)
+    writer.close()
+    return response
+
+async def client(host, port, image_bytes, num_requests, latencies):
+    """
+    One client: sends num_requests detection requests one after the other on a keep-alive connection.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    message = "POST /detect HTTP/1.1\r\nHost: {}\r\nContent-Type: application/octet-stream\r\nContent-Length: {}\r\n\r\n".format(
+        host, len(image_bytes)).encode("latin-1") + image_bytes
+
+    for _ in range(num_requests):
+        start_time = time.perf_counter()
+        writer.write(message)
+        await writer.drain()
+        status, body = await read_response(reader)
+        if status != 200:
+            raise RuntimeError("Request failed with status {}: {}".format(status, body))
+        latencies.append(time.perf_counter() - start_time)
+    writer.close()
+
+async def run_load(host, port, image_bytes, concurrency, num_requests):
+    """
+    Run concurrency clients at the same time, each sending num_requests requests.
+    @returns: the throughput in requests/sec, the client side latencies and the server stats
+    """
+    latencies = []
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client(host, port, image_bytes, num_requests, latencies) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start_time
+
+    _, stats = await request(host, port, "GET", "/stats")
+    return len(latencies) / elapsed, latencies, stats
+
+async def wait_for_server(host, port, timeout):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            await request(host, port, "GET", "/stats")
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load generator for server.py. Either targets a running server, or "
+        "spawns one server per --max-batch value and compares their throughput.")
+    parser.add_argument("image", help = "the image sent with every request")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--concurrency", type = int, default = 16, help = "number of concurrent clients")
+    parser.add_argument("--requests", type = int, default = 20, help = "requests sent by each client")
+    parser.add_argument("--max-batch", type = int, nargs = "*",
+        help = "spawn a server for each of these max batch sizes, e.g. --max-batch 1 8")
+    parser.add_argument("--server-args", default = "", help = "extra arguments for the spawned servers")
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        image_bytes = f.read()
+
+    runs = []
+    for max_batch in args.max_batch or [None]:
+        server = None
+        if max_batch is not None:
+            server = subprocess.Popen([sys.executable, "server.py", "--host", args.host, "--port", str(args.port),
+                "--max-batch", str(max_batch)] + args.server_args.split())
+        try:
+            asyncio.run(wait_for_server(args.host, args.port, timeout = 300))
+            runs.append((max_batch, asyncio.run(run_load(args.host, args.port, image_bytes, args.concurrency,
+                args.requests))))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    baseline = runs[0][1][0]
+    for max_batch, (throughput, latencies, stats) in runs:
+        print("max batch {:>4}: {:7.2f} req/s ({:.2f}x)  p50 {:7.1f} ms  p99 {:7.1f} ms  avg batch {:.1f}".format(
+            "-" if max_batch is None else max_batch, throughput, throughput / baseline,
+            utils.percentile(latencies, 50) * 1000, utils.percentile(latencies, 99) * 1000, stats["avg_batch_size"]))
+
+
+if __name__ == "__main__":
+    main()
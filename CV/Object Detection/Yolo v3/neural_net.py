@@ -1,15 +1,105 @@
+from collections import OrderedDict, namedtuple
+
 import numpy as np
 import torch
 from torch import nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 import torchvision.ops as tvo
 
+import datasets
 import utils
 
 
+# Operation types of the nodes in the execution plan built by create_module_list.
+# OP_MODULE runs module_list[index] on the previous output (convolutional and upsample layers).
+OP_MODULE = 0
+OP_SHORTCUT = 1
+OP_ROUTE = 2
+OP_YOLO = 3
+
+# Precisions supported for inference, see Yolo3.set_precision
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# A node of the execution plan.
+# op: one of the OP_* values above
+# index: index of the layer in the cfg (without the net section), same as in module_list
+# sources: absolute indexes of earlier layers whose feature maps this layer reads
+# save: whether the output of this layer is read by a later route/shortcut layer
+# release: feature maps that are not needed anymore once this layer has run
+PlanNode = namedtuple("PlanNode", ["op", "index", "sources", "save", "release"])
+
 class EmptyLayer(nn.Module):
     def __init__(self) -> None:
         super().__init__()
 
+class YoloHead(nn.Module):
+    """
+    Decodes the output of a yolo layer into bx, by, bw, bh, objectness and class confidences.
+
+    The grid offsets and the anchors depend only on the grid size, the dtype and the device, so
+    they are computed once and kept in a small LRU cache. One entry is kept per input resolution
+    seen by the network, and the decode itself is a single broadcasted expression.
+    """
+    def __init__(self, anchors, num_classes, stride, cache_size = 4) -> None:
+        """
+        @param anchors: a list of (width, height) tuples, in pixels of the network input
+        @param num_classes: number of classes predicted by the layer
+        @param stride: ratio between the network input size and this layer's grid size
+        @param cache_size: number of grid sizes for which offsets are cached
+        """
+        super().__init__()
+        self.num_anchors = len(anchors)
+        self.num_attrs = 5 + num_classes
+        self.stride = stride
+        self.cache_size = cache_size
+        # non persistent, so that the state_dict remains the same as before
+        self.register_buffer("anchors", torch.tensor(anchors, dtype = torch.float32), persistent = False)
+        self._grid_cache = OrderedDict()
+
+    def get_grid(self, grid_h, grid_w, dtype, device):
+        """
+        Returns the cell offsets (already multiplied by the stride) with shape [1, h, w, 1, 2] and
+        the anchors with shape [1, 1, 1, num_anchors, 2] for the given grid.
+        """
+        if torch.jit.is_tracing():
+            # the cache is not traced, the grid would be a constant of the traced graph anyway
+            return self._make_grid(grid_h, grid_w, dtype, device)
+
+        key = (grid_h, grid_w, self.stride, dtype, device)
+        if key in self._grid_cache:
+            self._grid_cache.move_to_end(key)
+            return self._grid_cache[key]
+
+        self._grid_cache[key] = self._make_grid(grid_h, grid_w, dtype, device)
+        if len(self._grid_cache) > self.cache_size:
+            self._grid_cache.popitem(last = False)
+        return self._grid_cache[key]
+
+    def _make_grid(self, grid_h, grid_w, dtype, device):
+        # we traverse across the x axis first and then across the y axis
+        x = torch.arange(grid_w, device = device, dtype = dtype).view(1, grid_w).expand(grid_h, grid_w)
+        y = torch.arange(grid_h, device = device, dtype = dtype).view(grid_h, 1).expand(grid_h, grid_w)
+        grid = torch.stack((x, y), -1).view(1, grid_h, grid_w, 1, 2) * self.stride
+        anchor_wh = self.anchors.to(device = device, dtype = dtype).view(1, 1, 1, self.num_anchors, 2)
+        return grid, anchor_wh
+
+    def forward(self, input):
+        input = input.float()
+        batch_size, _, grid_h, grid_w = input.shape
+        grid, anchor_wh = self.get_grid(grid_h, grid_w, input.dtype, input.device)
+
+        # [B, anchors * attrs, h, w] -> [B, h, w, anchors, attrs]. Rows end up ordered by cell
+        # and then by anchor, which is the order the rest of the code expects.
+        prediction = input.reshape(batch_size, self.num_anchors, self.num_attrs, grid_h, grid_w)
+        prediction = prediction.permute(0, 3, 4, 1, 2)
+
+        xy = torch.sigmoid(prediction[..., :2]) * self.stride + grid
+        wh = torch.exp(prediction[..., 2:4]) * anchor_wh
+        scores = torch.sigmoid(prediction[..., 4:])
+
+        return torch.cat((xy, wh, scores), -1).view(batch_size, -1, self.num_attrs)
+
 def create_module_list(layer_dic_list):
     """
     Read the dictionary containing information of various layers and convert the dic into 
@@ -17,6 +107,7 @@ def create_module_list(layer_dic_list):
     @param layer_dic_list: dictionary of layers
     @returns net_info: network's meta information
     @returns module_list: the module list 
+    @returns plan: the execution plan, a list of PlanNode, one per layer
     """
     # ModuleList is being used to enable transfer learning we might want to work on later.
     module_list = nn.ModuleList()
@@ -26,6 +117,13 @@ def create_module_list(layer_dic_list):
     prev_filter = 3
     filter_list = []
 
+    # stride of every layer's output w.r.t. the network input, required by the yolo heads
+    prev_stride = 1
+    stride_list = []
+
+    # (op, sources) of every layer, turned into the execution plan at the end
+    layer_ops = []
+
     for index, layer in enumerate(layer_dic_list):
         module = nn.Sequential()
         if layer[utils.LAYER_TYPE] == "convolutional":
@@ -48,8 +146,10 @@ def create_module_list(layer_dic_list):
                 bias = True
                 batch_normalize = 0
             
+            out_stride = prev_stride * stride
             conv_module = nn.Conv2d(prev_filter, out_filters, kernel, stride = stride, padding = padding, bias = bias)
             module.add_module("conv_{0}".format(index), conv_module)
+            layer_ops.append((OP_MODULE, ()))
 
             if batch_normalize:
                 batch_norm_module = nn.BatchNorm2d(out_filters)
@@ -60,45 +160,95 @@ def create_module_list(layer_dic_list):
                 module.add_module("leaky_{0}".format(index), activation_module)
 
         if layer[utils.LAYER_TYPE] == "shortcut":
+            out_stride = prev_stride
             shortcut_module = EmptyLayer()
             module.add_module("shortcut_{0}".format(index), shortcut_module)
+            # the other operand of the shortcut is always the previous layer's output
+            layer_ops.append((OP_SHORTCUT, (index + int(layer["from"]),)))
 
         if layer[utils.LAYER_TYPE] == "upsample":
-            stride = layer["stride"]
+            stride = int(layer["stride"])
+            out_stride = prev_stride // stride
             upsample_module = nn.Upsample(scale_factor = stride, mode="bilinear")
             module.add_module("upsample_{0}".format(index), upsample_module)
+            layer_ops.append((OP_MODULE, ()))
 
         if layer[utils.LAYER_TYPE] == "route":
             route_module = EmptyLayer()
             module.add_module("route_{0}".format(index), route_module)
-            prev_layers = layer["layers"]
-            if "," in prev_layers:
-                prev_layers = prev_layers.split(",")
-                prev_layer1 = int(prev_layers[0])
-                prev_layer2 = int(prev_layers[1])
-
-                if prev_layer1 < 0:
-                    prev_layer1 = index + prev_layer1
-                if prev_layer2 < 0:
-                    prev_layer2 = index + prev_layer2
-
-                filter1 = filter_list[prev_layer1]
-                filter2 = filter_list[prev_layer2]
-                out_filters = filter1 + filter2
-            else:
-                prev_layers = int(prev_layers)
-                out_filters = filter_list[prev_layers]
+            # resolve the (relative) layer indexes once, forward only deals with absolute indexes
+            prev_layers = [int(prev_layer) for prev_layer in layer["layers"].split(",")]
+            prev_layers = [index + prev_layer if prev_layer < 0 else prev_layer for prev_layer in prev_layers]
+
+            out_filters = sum(filter_list[prev_layer] for prev_layer in prev_layers)
+            out_stride = stride_list[prev_layers[0]]
+            layer_ops.append((OP_ROUTE, tuple(prev_layers)))
 
         if layer[utils.LAYER_TYPE] == "yolo":
-            yolo_module = EmptyLayer()
+            out_stride = prev_stride
+            anchors = utils.get_anchors(layer["anchors"].split(","), layer["mask"].split(","))
+            yolo_module = YoloHead(anchors, int(layer["classes"]), prev_stride)
             module.add_module("yolo_{0}".format(index), yolo_module)
+            layer_ops.append((OP_YOLO, ()))
 
         module_list.append(module)
         prev_filter = out_filters
         filter_list.append(prev_filter)
+        prev_stride = out_stride
+        stride_list.append(prev_stride)
+
+    plan = build_execution_plan(layer_ops)
+    return net_info, module_list, plan
 
+def build_execution_plan(layer_ops):
+    """
+    Convert the (op, sources) pairs of all the layers into a list of PlanNode. 
     
-    return net_info, module_list
+    A liveness analysis finds the last layer reading each feature map. Only the feature maps
+    read by a route/shortcut layer are kept, and each of them is released as soon as its last 
+    reader has run.
+    @param layer_ops: a list of (op, sources) tuples, one per layer
+    @returns plan: a list of PlanNode
+    """
+    last_use = {}
+    for index, (_, sources) in enumerate(layer_ops):
+        for source in sources:
+            last_use[source] = index
+
+    plan = []
+    for index, (op, sources) in enumerate(layer_ops):
+        release = tuple(source for source in set(sources) if last_use[source] == index)
+        plan.append(PlanNode(op, index, sources, index in last_use, release))
+
+    return plan
+
+def find_residual_blocks(plan):
+    """
+    Find the residual blocks of darknet-53 in the execution plan: two layers run one after the other,
+    followed by a shortcut adding their input (from=-3). The outputs of the two inner layers must not be
+    read by any other layer, so that the whole block can be run as a single function.
+    @param plan: the execution plan returned by create_module_list
+    @returns blocks: a dict mapping the index of the first layer of each block to the index of its shortcut
+    """
+    blocks = {}
+    for node in plan:
+        start = node.index - 2
+        if node.op != OP_SHORTCUT or start < 0 or node.sources != (node.index - 3,):
+            continue
+        if all(plan[index].op == OP_MODULE and not plan[index].save for index in (start, start + 1)):
+            blocks[start] = node.index
+    return blocks
+
+def get_tile_origins(length, tile_size, overlap):
+    """
+    Start of every tile along an axis of an image. Consecutive tiles overlap by at least overlap pixels
+    and the last tile ends at the end of the axis.
+    """
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, tile_size - overlap))
+    origins.append(length - tile_size)
+    return origins
 
 def perform_math_on_yolo_output(input, anchors, height):
     """
@@ -110,265 +260,395 @@ def perform_math_on_yolo_output(input, anchors, height):
     to their correct position in the output grid; sigmoid on objectness score; and sigmoid on class 
     confidence scores. Also, multiply the anchor width and height to natural exponent of tw and th 
     values recieved from the network output.
-    
+
+    The network itself uses the YoloHead modules created by create_module_list, which cache the
+    grid and the anchors. This function builds a throwaway head and is kept for standalone use.
     """
-    input = input.float()
-    batch_size = input.size(0)
-    grid_size = input.size(2)
     stride = height // input.size(3)
-
-    anc_tensor = torch.tensor(anchors)
-    anc_tensor = anc_tensor.repeat(grid_size*grid_size,1)
-    anc_tensor = anc_tensor/stride
-    
-    input = input.view(batch_size, -1, grid_size * grid_size)
-    input = input.transpose(1,2).contiguous()
-    input = input.view(batch_size, grid_size * grid_size * 3, -1)
-
-    # perform yolo calculations
-    input[:, :, 0] = torch.sigmoid(input[:, :, 0])
-    input[:, :, 1] = torch.sigmoid(input[:, :, 1])
-    input[:, :, 4] = torch.sigmoid(input[:, :, 4])
-    input[:, :, 5:] = torch.sigmoid(input[:, :, 5:]) 
-    input[:, :,2] = anc_tensor[:,0] * torch.exp(input[:, :, 2])
-    input[:, :,3] = anc_tensor[:,1] * torch.exp(input[:, :, 3])
-
-    x_cord_tensor, y_cord_tensor = utils.get_mesh_grid(grid_size)
-    
-    input[:, :, 0] = input[:, :, 0] + x_cord_tensor.squeeze(1)
-    input[:, :, 1] = input[:, :, 1] + y_cord_tensor.squeeze(1)
-    # multiply the coordinates by stride 
-    input[:, :, :4] = input[:, :, :4] * stride
-    
-    return input
+    num_classes = input.size(1) // len(anchors) - 5
+    return YoloHead(anchors, num_classes, stride).to(input.device)(input)
 
 class Yolo3(nn.Module):
     def __init__(self, cfg_file):
         super().__init__()
         self.layer_dic_list = utils.parse_cfg(cfg_file)
-        self.net_info, self.module_list = create_module_list(self.layer_dic_list)
+        self.net_info, self.module_list, self.plan = create_module_list(self.layer_dic_list)
+        self.fused = False
+        self.channels_last = False
+        self.precision = "fp32"
+        self.residual_blocks = find_residual_blocks(self.plan)
+        self.activation_checkpointing = False
 
 
     def forward(self, input):
-        # net_info layer not required 
-        layer_dic_list = self.layer_dic_list[1:]
-        module_list = self.module_list
-        
-        # a list to hold various feature maps. 
-        # This will be required during route and shortcut layer when we'll 
-        # need to retrieve and concatenate feature maps from previous layers.
-        feature_map_list = []
+        if self.channels_last:
+            input = input.contiguous(memory_format = torch.channels_last)
 
-        # Flag to tell us if we have an output from the yolo layer or not.
-        dtctn_exists = False
-        
-        for index, layer_dic in enumerate(layer_dic_list):
-            if layer_dic[utils.LAYER_TYPE] == "convolutional":
-                output = module_list[index](input)
-
-            elif layer_dic[utils.LAYER_TYPE] == "shortcut":
-                from_layer = int(layer_dic["from"])
-                abs_shrtct_layer = index + from_layer
-                output = feature_map_list[index - 1] + feature_map_list[abs_shrtct_layer]
-
-            elif layer_dic[utils.LAYER_TYPE] == "upsample":
-                output = module_list[index](input)
-
-            elif layer_dic[utils.LAYER_TYPE] == "route":
-                layers = layer_dic["layers"]
-                
-                # if the output is route layer depends on two layers 
-                if "," in layers:
-                    layers = layers.split(",")
-                    layer1 = int(layers[0])
-                    layer2 = int(layers[1])
-
-                    if layer1 < 0:
-                        layer1 = index + layer1
-                    if layer2 < 0:
-                        layer2 = index + layer2
-
-                    out1 = feature_map_list[layer1]
-                    out2 = feature_map_list[layer2]
-                    output = torch.cat((out1, out2), 1)
-                
-                # if the output is route layer depends on only one layer
-                else:
-                    layer = int(layers)
-                    absolute_route_layer = index + layer
-                    output = feature_map_list[absolute_route_layer]
-                    
-            elif layer_dic[utils.LAYER_TYPE] == "yolo":    
-
-                height = int(self.net_info["height"])
-                anchor_str = layer_dic["anchors"].split(",")
-                mask = layer_dic["mask"].split(",")
-
-                anchors = utils.get_anchors(anchor_str, mask)
-                
-                output = perform_math_on_yolo_output(input, anchors, height)
-                if dtctn_exists:
-                    detection_tensor = torch.cat((detection_tensor, output), 1)
-                else:
-                    detection_tensor = output
-                    dtctn_exists = True
-            feature_map_list.append(output)
-            input = output
+        # In bf16, autocast runs the convolutions in bf16. The yolo heads convert their input back to 
+        # fp32, and the decode only uses ops autocast leaves in the precision of their input.
+        with torch.autocast(input.device.type, dtype = torch.bfloat16, enabled = self.precision == "bf16"):
+            detection_tensor = self.run_plan(input)
         
         # TODO: Check this implementation
         detection_tensor = torch.nan_to_num(detection_tensor)
         return detection_tensor
 
-    # The load_weights functions has been copied as it is from Ayoosh kathuria's blog.
-    def load_weights(self, weightfile):
-    #Open the weights file
-        fp = open(weightfile, "rb")
-        
+    def run_plan(self, input):
+        """
+        Run the execution plan on input, returns the concatenated outputs of the yolo layers.
+        Unlike forward, this doesn't apply the precision, the memory format or nan_to_num, which
+        makes it the entry point for tracing and export (see export.py).
+        """
+        # feature maps of the layers that are read later on by route and shortcut layers,
+        # indexed by layer. Everything else is dropped as soon as the next layer has run.
+        feature_maps = {}
+        detections = []
+
+        # While training with activation checkpointing, only the input of every residual block is kept
+        # for backward, the activations inside the block are recomputed from it.
+        checkpoint_blocks = self.activation_checkpointing and self.training and torch.is_grad_enabled()
+
+        position = 0
+        while position < len(self.plan):
+            node = self.plan[position]
+            if checkpoint_blocks and node.index in self.residual_blocks:
+                # the non reentrant variant works with the no_sync gradient accumulation of DistributedDataParallel
+                input = checkpoint(self._run_residual_block, input, node.index, use_reentrant = False)
+                # go on as if the shortcut closing the block had just run
+                node = self.plan[self.residual_blocks[node.index]]
+
+            elif node.op == OP_MODULE:
+                input = self.module_list[node.index](input)
+
+            elif node.op == OP_SHORTCUT:
+                input = input + feature_maps[node.sources[0]]
+
+            elif node.op == OP_ROUTE:
+                if len(node.sources) == 1:
+                    input = feature_maps[node.sources[0]]
+                else:
+                    input = torch.cat([feature_maps[source] for source in node.sources], 1)
+
+            elif node.op == OP_YOLO:
+                input = self.module_list[node.index](input)
+                detections.append(input)
+
+            if node.save:
+                feature_maps[node.index] = input
+            for source in node.release:
+                del feature_maps[source]
+            position = node.index + 1
+
+        return torch.cat(detections, 1)
+
+    def _run_residual_block(self, input, start):
+        return input + self.module_list[start + 1](self.module_list[start](input))
+
+    def detect_tiled(self, image, tile_size = None, overlap = 64, batch_size = 8, cnf_thres = 0.5, iou_thres = 0.4):
+        """
+        Detect objects in an image much larger than the network input without downscaling it, so that
+        small objects remain visible. The image is cut into overlapping tile_size x tile_size tiles which
+        go through the network batch_size at a time; only the detections of the tiles are kept, so the
+        memory doesn't depend on the number of tiles. The boxes are mapped back to the image and the
+        objects found by several overlapping tiles are merged by class-wise NMS.
+
+        @param image: a [3, H, W] tensor, either uint8 (e.g. the output of PILToTensor) or float in [0, 1].
+            A uint8 image is only converted to float one batch of tiles at a time, which keeps the memory
+            4 times smaller than a float image
+        @param tile_size: size of the tiles, utils.IMAGE_SIZE if None
+        @param overlap: minimum overlap of neighbouring tiles in pixels, about the size of the largest
+            object that should be found whole in at least one tile, 0 <= overlap < tile_size
+        @returns detections: a [M, 7] tensor, same columns as analyze_batch_detections, in pixels of the
+            image, ordered by class and then by descending class confidence
+        """
+        tile_size = tile_size or utils.IMAGE_SIZE
+        if not 0 <= overlap < tile_size:
+            raise ValueError("The overlap of the tiles must be at least 0 and less than the tile size {}, got {}"
+                .format(tile_size, overlap))
+        _, height, width = image.shape
+        if height < tile_size or width < tile_size:
+            pad_value = datasets.PAD_COLOR[0] if image.dtype == torch.uint8 else datasets.PAD_COLOR[0] / 255
+            padded = image.new_full((image.size(0), max(height, tile_size), max(width, tile_size)), pad_value)
+            padded[:, :height, :width] = image
+            image = padded
+
+        origins = [(x, y) for y in get_tile_origins(image.size(1), tile_size, overlap)
+            for x in get_tile_origins(image.size(2), tile_size, overlap)]
+        results = []
+        for start in range(0, len(origins), batch_size):
+            batch_origins = origins[start:start + batch_size]
+            # the tiles are views of the image, only the batch is copied
+            tiles = torch.stack([image[:, y:y + tile_size, x:x + tile_size] for x, y in batch_origins])
+            if tiles.dtype == torch.uint8:
+                tiles = tiles.float().div_(255)
+            detections, tile_indices = batched_nms(self(tiles), cnf_thres, iou_thres, sort_by_class = False)
+            offsets = torch.tensor(batch_origins, dtype = detections.dtype, device = detections.device)
+            detections[:, :4] += offsets[tile_indices].repeat(1, 2)
+            results.append(detections)
+
+        detections = torch.cat(results)
+        keep = tvo.batched_nms(detections[:, :4], detections[:, 5], detections[:, 6].long(), iou_thres)
+        keep = keep[torch.sort(detections[keep, 6], stable = True)[1]]
+        detections = detections[keep]
+        detections[:, [0, 2]] = detections[:, [0, 2]].clamp(0, width)
+        detections[:, [1, 3]] = detections[:, [1, 3]].clamp(0, height)
+        return detections
+
+    def yolo_heads(self):
+        """
+        Returns the YoloHead modules of the network, in the order their outputs appear in the detection tensor.
+        """
+        return [self.module_list[node.index][0] for node in self.plan if node.op == OP_YOLO]
+
+    def darknet_tensors(self):
+        """
+        Returns the parameters and buffers of the network in the order in which they are stored
+        in a darknet weights file. For every convolutional layer, that is either the batch norm
+        bias, weight, running mean and running variance or the conv bias, followed by the conv weight.
+        """
+        tensors = []
+        for node in self.plan:
+            if self.layer_dic_list[node.index + 1][utils.LAYER_TYPE] != "convolutional":
+                continue
+
+            conv = self.module_list[node.index][0]
+            if "batch_normalize" in self.layer_dic_list[node.index + 1]:
+                bn = self.module_list[node.index][1]
+                tensors.extend([bn.bias, bn.weight, bn.running_mean, bn.running_var])
+            else:
+                tensors.append(conv.bias)
+            tensors.append(conv.weight)
+
+        return tensors
+
+    def load_weights(self, weightfile, fused = False):
+        """
+        Load the weights of the network, either from the darknet weights file or from a
+        cache written by save_weights_cache (any file ending with .pt).
+
+        The darknet file is memory mapped instead of being read in memory. Every parameter is
+        copied straight from the mapped pages, so the file is never held in memory twice.
+        The size of the file is validated against the network before any parameter is touched.
+
+        @param fused: call fuse() once the weights are loaded, for inference
+        """
+        if self.fused:
+            raise RuntimeError("The weights have to be loaded before the network is fused")
+
+        if weightfile.endswith(".pt"):
+            checkpoint = torch.load(weightfile, map_location = "cpu")
+            self.load_state_dict(checkpoint["state_dict"])
+            self.header = checkpoint["header"]
+            self.seen = self.header[3]
+        else:
+            self._load_darknet_weights(weightfile)
+
+        if fused:
+            self.fuse()
+
+    def _load_darknet_weights(self, weightfile):
         #The first 5 values are header information 
         # 1. Major version number
         # 2. Minor Version Number
         # 3. Subversion number 
         # 4,5. Images seen by the network (during training)
-        header = np.fromfile(fp, dtype = np.int32, count = 5)
-        self.header = torch.from_numpy(header)
-        self.seen = self.header[3]   
-            
-        weights = np.fromfile(fp, dtype = np.float32)
-            
+        header = np.fromfile(weightfile, dtype = np.int32, count = 5)
+
+        # copy on write mode, so that torch gets a writable array without the file being copied
+        weights = np.memmap(weightfile, dtype = np.float32, mode = "c", offset = header.nbytes)
+
+        tensors = self.darknet_tensors()
+        num_expected = sum(tensor.numel() for tensor in tensors)
+        if weights.size != num_expected:
+            raise ValueError("{} contains {} weights, but the network defined by the cfg expects {}"
+                .format(weightfile, weights.size, num_expected))
+
         ptr = 0
-        for i in range(len(self.module_list)):
-            module_type = self.layer_dic_list[i + 1][utils.LAYER_TYPE]
-        
-            #If module_type is convolutional load weights
-            #Otherwise ignore.
-                
-            if module_type == "convolutional":
-                model = self.module_list[i]
-                try:
-                    batch_normalize = int(self.layer_dic_list[i+1]["batch_normalize"])
-                except:
-                    batch_normalize = 0
-                
-                conv = model[0]
-                    
-                    
-                if (batch_normalize):
-                    bn = model[1]
-            
-                    #Get the number of weights of Batch Norm Layer
-                    num_bn_biases = bn.bias.numel()
-            
-                    #Load the weights
-                    bn_biases = torch.from_numpy(weights[ptr:ptr + num_bn_biases])
-                    ptr += num_bn_biases
-            
-                    bn_weights = torch.from_numpy(weights[ptr: ptr + num_bn_biases])
-                    ptr  += num_bn_biases
-            
-                    bn_running_mean = torch.from_numpy(weights[ptr: ptr + num_bn_biases])
-                    ptr  += num_bn_biases
-            
-                    bn_running_var = torch.from_numpy(weights[ptr: ptr + num_bn_biases])
-                    ptr  += num_bn_biases
-            
-                    #Cast the loaded weights into dims of model weights. 
-                    bn_biases = bn_biases.view_as(bn.bias.data)
-                    bn_weights = bn_weights.view_as(bn.weight.data)
-                    bn_running_mean = bn_running_mean.view_as(bn.running_mean)
-                    bn_running_var = bn_running_var.view_as(bn.running_var)
-            
-                    #Copy the data to model
-                    bn.bias.data.copy_(bn_biases)
-                    bn.weight.data.copy_(bn_weights)
-                    bn.running_mean.copy_(bn_running_mean)
-                    bn.running_var.copy_(bn_running_var)
-                    
-                else:
-                    #Number of biases
-                    num_biases = conv.bias.numel()
-                    
-                    #Load the weights
-                    conv_biases = torch.from_numpy(weights[ptr: ptr + num_biases])
-                    ptr = ptr + num_biases
-                    
-                    #reshape the loaded weights according to the dims of the model weights
-                    conv_biases = conv_biases.view_as(conv.bias.data)
-                    
-                    #Finally copy the data
-                    conv.bias.data.copy_(conv_biases)
-                        
-                #Let us load the weights for the Convolutional layers
-                num_weights = conv.weight.numel()
-                    
-                #Do the same as above for weights
-                conv_weights = torch.from_numpy(weights[ptr:ptr+num_weights])
+        with torch.no_grad():
+            for tensor in tensors:
+                num_weights = tensor.numel()
+                tensor.copy_(torch.from_numpy(weights[ptr:ptr + num_weights]).view_as(tensor))
                 ptr = ptr + num_weights
-                    
-                conv_weights = conv_weights.view_as(conv.weight.data)
-                conv.weight.data.copy_(conv_weights)
 
+        # dropping the last reference unmaps the file
+        del weights
 
-def analyze_detections(img, cnf_thres = 0.5, iou_thres = 0.4):
+        self.header = torch.from_numpy(header)
+        self.seen = self.header[3]
+
+    def fuse(self, channels_last = False):
+        """
+        Prepare the network for inference by folding every batch norm layer into the weights and
+        the bias of the convolution preceding it, which saves one pass over each feature map.
+        The network is put in eval mode and can't be trained afterwards.
+
+        @param channels_last: also convert the network (and its inputs) to the channels last
+        memory format, which is usually faster for convolutions on CPU
+        """
+        self.eval()
+        for node in self.plan:
+            module = self.module_list[node.index]
+            if node.op != OP_MODULE or len(module) < 2 or not isinstance(module[1], nn.BatchNorm2d):
+                continue
+
+            # conv_i, batchnorm_i, leaky_i becomes conv_i (with a bias), leaky_i
+            children = list(module.named_children())
+            fused_module = nn.Sequential()
+            fused_module.add_module(children[0][0], fuse_conv_bn_eval(module[0], module[1]))
+            for name, child in children[2:]:
+                fused_module.add_module(name, child)
+            self.module_list[node.index] = fused_module
+
+        self.fused = True
+        if channels_last:
+            self.to(memory_format = torch.channels_last)
+            self.channels_last = True
+        return self
+
+    def set_precision(self, precision, calibration_loader = None, num_calibration_batches = 10, backend = "fbgemm"):
+        """
+        Select the precision used for inference on CPU. The yolo decode always runs in fp32.
+        - fp32: the default.
+        - bf16: the network runs under bfloat16 autocast. This also works for training, the parameters
+          and the gradients remain in fp32.
+        - int8: post-training static quantization of the convolutional layers. The network is fused, 
+          and every convolutional block (conv + leaky) is quantized and dequantized around. The 
+          quantization ranges are calibrated on the first num_calibration_batches batches of 
+          calibration_loader, e.g. a dataloader over an ObjectDataSet. This can't be undone.
+
+        @param backend: the quantized engine, fbgemm for x86 and qnnpack for ARM
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of {}, got {}".format(PRECISIONS, precision))
+        if self.precision == "int8" and precision != "int8":
+            raise RuntimeError("A quantized network can't be converted back to {}".format(precision))
+
+        if precision == "int8" and self.precision != "int8":
+            if calibration_loader is None:
+                raise ValueError("int8 requires a calibration_loader")
+            self._quantize(calibration_loader, num_calibration_batches, backend)
+        self.precision = precision
+        return self
+
+    def _quantize(self, calibration_loader, num_calibration_batches, backend):
+        if not self.fused:
+            self.fuse()
+        if self.channels_last:
+            self.to(memory_format = torch.contiguous_format)
+            self.channels_last = False
+
+        # calibrate on fp32 activations
+        self.precision = "fp32"
+        torch.backends.quantized.engine = backend
+        qconfig = torch.quantization.get_default_qconfig(backend)
+        for node in self.plan:
+            module = self.module_list[node.index]
+            if node.op != OP_MODULE or not isinstance(module[0], nn.Conv2d):
+                continue
+
+            # the feature maps are quantized when entering the block and dequantized when leaving it,
+            # so that shortcut, route, upsample and yolo layers keep working on fp32 feature maps
+            block = nn.Sequential(OrderedDict([("quant", torch.quantization.QuantStub())] +
+                list(module.named_children()) + [("dequant", torch.quantization.DeQuantStub())]))
+            block.qconfig = qconfig
+            self.module_list[node.index] = block
+
+        torch.quantization.prepare(self, inplace = True)
+        with torch.no_grad():
+            for batch_idx, batch in enumerate(calibration_loader):
+                if batch_idx == num_calibration_batches:
+                    break
+                # the loader may return labels and paths along with the images
+                self(batch[0] if isinstance(batch, (list, tuple)) else batch)
+        torch.quantization.convert(self, inplace = True)
+
+    def save_weights_cache(self, cache_file):
+        """
+        Save the weights of the network and the darknet header in pytorch's native format.
+        Loading this file with load_weights is a lot faster than parsing the darknet file.
+        """
+        torch.save({"header": self.header, "state_dict": self.state_dict()}, cache_file)
+
+
+def batched_nms(detections, cnf_thres = 0.5, iou_thres = 0.4, top_k = 3000, sort_by_class = True):
     """
-    Analyse all the detections given by the yolo layer. Filter out the predictions
-    which are below a certain threshold (cnf_thres). Apply NMS using iou_thres.  
+    Confidence filtering, top-k pre-filter and class-wise NMS over a whole batch, see analyze_batch_detections.
+    The result is returned as a single tensor, which keeps this function traceable for export.
+
+    @param sort_by_class: order the detections of an image by class and then by class confidence.
+        Otherwise they are ordered by class confidence only.
+    @returns result: a [M, 7] tensor of detections for the whole batch. Each row contains
+        bx1, by1, bx2, by2, conf, class_conf, class.
+    @returns image_indices: a [M] tensor, the image of each detection
     """
-    img = img[img[:, 4] > cnf_thres]
-    
-    # no detections
-    if img.size()[0] == 0:
-        return 0
+    batch_size, num_preds, num_attrs = detections.shape
+    num_classes = num_attrs - 5
+
+    # top-k pre-filter on objectness. Predictions below the threshold are dropped afterwards,
+    # so the threshold semantics are unchanged as long as fewer than top_k predictions pass it.
+    top_conf, top_indices = detections[:, :, 4].topk(min(top_k, num_preds), dim = 1)
+    detections = detections.gather(1, top_indices.unsqueeze(2).expand(-1, -1, num_attrs))
+    keep_mask = top_conf > cnf_thres
+
+    image_indices = torch.arange(batch_size, device = detections.device)
+    image_indices = image_indices.unsqueeze(1).expand_as(keep_mask)[keep_mask]
+    detections = detections[keep_mask]
 
     # convert bx, by, bw, bh into bx1, by1, bx2, by2
-    boxes = img.new(img.shape)
-    boxes[:,0] = img[:, 0] - img[:, 2]/2
-    boxes[:,1] = img[:, 1] - img[:, 3]/2
-    boxes[:,2] = img[:, 0] + img[:, 2]/2
-    boxes[:,3] = img[:, 1] + img[:, 3]/2
-    img[:, :4] = boxes[:,:4]
-    
+    half_wh = detections[:, 2:4] / 2
+    boxes = torch.cat((detections[:, :2] - half_wh, detections[:, :2] + half_wh), 1)
+
     # get the max class confidence and corresponding class
-    max_values, class_values = torch.max(img[:,5:], 1)
+    max_values, class_values = torch.max(detections[:, 5:], 1)
+
+    # boxes from different images or different classes never suppress each other
+    groups = image_indices * num_classes + class_values
+    keep = tvo.batched_nms(boxes, max_values, groups, iou_thres)
+
+    # batched_nms returns the kept indices sorted by score. A stable sort on the group
+    # brings them in (image, class) order while preserving the score order inside a group.
+    if sort_by_class:
+        keep = keep[torch.sort(groups[keep], stable = True)[1]]
 
     # create a tensor that has 7 elements: bx1, by1, bx2, by2, conf, class_conf, class
-    img = torch.cat((img[:, :5], max_values.float().unsqueeze(1), class_values.float().unsqueeze(1)), 1)
-    
-    dtctn_tnsr_exsts = False
-    classes = torch.unique(img[:, 6])
-    for cls in classes:
-        # retrieve all the rows which correspond to class cls
-        cls_tensor = img[torch.where(img[:, 6] == cls)]
-
-        # sort cls_tensor according to max confidence
-        cls_tensor = cls_tensor[cls_tensor[:,5].sort(descending = True)[1]]
-           
-        # box_iou takes tensors which have only 4 columns
-        iou_tensor = tvo.box_iou(cls_tensor[:,:4], cls_tensor[:,:4])
-    
-        rejected_indices = []
-        detected_indices = []
+    result = torch.cat((boxes[keep], detections[keep, 4:5], max_values[keep].float().unsqueeze(1),
+        class_values[keep].float().unsqueeze(1)), 1)
 
-        #TODO: have a helper function to generate an image with all bbs drawn at this stage
-        for row in range(iou_tensor.size(0)):
-            if row in rejected_indices:
-                continue
-            # get all the rows which have iou greater than the threshold. the row
-            # itself would have an IOU of 1 
-            exceeding_thres_tensor = torch.where(iou_tensor[row] > iou_thres)[0]
-            
-            # all the rows except the current row are discarded owing to NMS
-            rejected_indices.extend(exceeding_thres_tensor.tolist())
+    return result, image_indices[keep]
 
-            # the current row is added to the detected tensor list
-            detected_indices.append(row)
-        
-        if dtctn_tnsr_exsts:
-            detection_tensor = torch.cat((detection_tensor, cls_tensor[detected_indices]), 0)
-                
-        else:
-            detection_tensor = cls_tensor[detected_indices]
-            dtctn_tnsr_exsts = True
-    try:
-        return detection_tensor
-    except:
+def analyze_batch_detections(detections, cnf_thres = 0.5, iou_thres = 0.4, top_k = 3000):
+    """
+    Analyse the detections of a whole batch in one go. Filter out the predictions which are
+    below a certain threshold (cnf_thres), keep at most top_k of the remaining predictions per
+    image and apply class-wise NMS using iou_thres.
+
+    Every (image, class) pair is treated as a separate NMS group, so a single batched NMS call
+    replaces the per-image, per-class loops. Within an image, the detections are ordered by
+    class and then by descending class confidence, i.e. the same order analyze_detections
+    has always produced.
+
+    @param detections: the [B, N, 5 + num_classes] tensor returned by Yolo3.forward
+    @param cnf_thres: objectness threshold below which a prediction is discarded
+    @param iou_thres: predictions of the same class overlapping more than this are suppressed
+    @param top_k: maximum number of predictions per image that make it to NMS
+    @returns: a list with one [M, 7] tensor per image. Each row contains
+        bx1, by1, bx2, by2, conf, class_conf, class. M is 0 if nothing was detected.
+    """
+    result, image_indices = batched_nms(detections, cnf_thres, iou_thres, top_k)
+    counts = torch.bincount(image_indices, minlength = detections.size(0))
+    return list(result.split(counts.tolist()))
+
+def analyze_detections(img, cnf_thres = 0.5, iou_thres = 0.4):
+    """
+    Analyse all the detections given by the yolo layer for one image. Filter out the predictions
+    which are below a certain threshold (cnf_thres). Apply NMS using iou_thres.
+
+    @returns: a [M, 7] tensor of detections, or 0 if nothing was detected.
+    """
+    detection_tensor = analyze_batch_detections(img.unsqueeze(0), cnf_thres, iou_thres)[0]
+
+    # no detections
+    if detection_tensor.size(0) == 0:
         return 0
+
+    return detection_tensor
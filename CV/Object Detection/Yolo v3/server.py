@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torchvision.transforms.functional as TF
+from PIL import Image
+
+import datasets
+import neural_net
+import utils
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent detection requests into micro-batches for one warm Yolo3 network.
+
+    A batch is run as soon as max_batch requests are waiting, or max_wait seconds after its first
+    request arrived, whichever comes first. The forward passes run one at a time on a dedicated 
+    thread. Decoding the images, NMS and mapping the boxes back run on a pool of worker threads, 
+    so the next batch can go through the network while the previous one is post-processed.
+
+    At most max_queue requests wait for a batch. Beyond that, detect raises asyncio.QueueFull right away
+    instead of letting the requests pile up in memory and their latency grow without limit.
+    """
+    def __init__(self, net, max_batch = 8, max_wait = 0.01, num_workers = 4, cnf_thres = 0.5, iou_thres = 0.4,
+        max_queue = 64) -> None:
+        self.net = net
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.cnf_thres = cnf_thres
+        self.iou_thres = iou_thres
+        self.forward_executor = ThreadPoolExecutor(1)
+        self.workers = ThreadPoolExecutor(num_workers)
+
+        # created by start, inside the event loop
+        self.queue = None
+        self.latencies = deque(maxlen = 10000)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_rejected = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize = self.max_queue)
+        return asyncio.ensure_future(self._run())
+
+    def _preprocess(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        original_size = image.size
+        image = datasets.resize_image(image, (utils.IMAGE_SIZE, utils.IMAGE_SIZE))
+        return TF.to_tensor(image), original_size
+
+    def _forward(self, features):
+        with torch.no_grad():
+            return self.net(features)
+
+    def _postprocess(self, output, original_sizes):
+        detections = neural_net.analyze_batch_detections(output, self.cnf_thres, self.iou_thres)
+        input_shape = (utils.IMAGE_SIZE, utils.IMAGE_SIZE)
+        return [utils.unmap_boxes(det, size, input_shape).tolist() for det, size in zip(detections, original_sizes)]
+
+    async def detect(self, image_bytes):
+        """
+        Detect the objects in an encoded image.
+        @returns: a list of detections, each being bx1, by1, bx2, by2, conf, class_conf, class in
+            coordinates of the original image
+        @raises asyncio.QueueFull: if max_queue requests are already waiting
+        """
+        loop = asyncio.get_event_loop()
+        start_time = time.perf_counter()
+        # don't decode an image that can't be queued
+        if self.queue.full():
+            self.num_rejected += 1
+            raise asyncio.QueueFull()
+        features, original_size = await loop.run_in_executor(self.workers, self._preprocess, image_bytes)
+
+        future = loop.create_future()
+        try:
+            self.queue.put_nowait((features, original_size, future))
+        except asyncio.QueueFull:
+            self.num_rejected += 1
+            raise
+        detections = await future
+
+        self.latencies.append(time.perf_counter() - start_time)
+        return detections
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            futures = [item[2] for item in batch]
+            try:
+                features = torch.stack([item[0] for item in batch])
+                output = await loop.run_in_executor(self.forward_executor, self._forward, features)
+            except Exception as error:
+                self._fail(futures, error)
+                continue
+
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            asyncio.ensure_future(self._finish(output, [item[1] for item in batch], futures))
+
+    async def _finish(self, output, original_sizes, futures):
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(self.workers, self._postprocess, output,
+                original_sizes)
+        except Exception as error:
+            self._fail(futures, error)
+            return
+
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _fail(self, futures, error):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "rejected": self.num_rejected,
+            "avg_batch_size": self.num_requests / max(self.num_batches, 1),
+            "p50_ms": utils.percentile(latencies, 50) * 1000,
+            "p99_ms": utils.percentile(latencies, 99) * 1000}
+
+class DetectionServer:
+    """
+    A minimal HTTP/1.1 server (keep-alive, no external dependencies) in front of a MicroBatcher.
+
+    POST /detect with the encoded image as body returns {"detections": [...]}, each detection
+    being {"box": [x1, y1, x2, y2], "confidence": ..., "class": ...}, or 503 when the queue of the
+    batcher is full.
+    GET /stats returns the queue depth, the number of requests, batches and rejected requests, and the
+    p50/p99 latency.
+    """
+    def __init__(self, batcher, classes) -> None:
+        self.batcher = batcher
+        self.classes = classes
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            return "200 OK", self.batcher.stats()
+
+        if method == "POST" and path == "/detect":
+            try:
+                detections = await self.batcher.detect(body)
+            except asyncio.QueueFull:
+                return "503 Service Unavailable", {"error": "too many requests waiting, try again later"}
+            except (OSError, ValueError) as error:
+                # the body is not an image PIL can decode
+                return "400 Bad Request", {"error": str(error)}
+            except Exception as error:
+                return "500 Internal Server Error", {"error": str(error)}
+            return "200 OK", {"detections": [{"box": det[:4], "confidence": det[5], "class": self.classes[int(det[6])]}
+                for det in detections]}
+
+        return "404 Not Found", {"error": "unknown endpoint {} {}".format(method, path)}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.route(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n"
+                    .format(status, len(data)).encode("latin-1") + data)
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(server, host, port):
+    batch_task = server.batcher.start()
+    tcp_server = await asyncio.start_server(server.handle_connection, host, port)
+    print("Serving on {}:{}".format(host, port), flush = True)
+    async with tcp_server:
+        await asyncio.gather(tcp_server.serve_forever(), batch_task)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve Yolo v3 detections over HTTP with dynamic micro-batching.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--weights", default = "assets/yolov3.weights", help = "darknet weights or a .pt cache")
+    parser.add_argument("--classes", default = "assets/coco.names", help = "file with the names of the classes")
+    parser.add_argument("--max-batch", type = int, default = 8, help = "max requests in a batch")
+    parser.add_argument("--max-wait-ms", type = float, default = 10, help = "max time a request waits for a batch to fill")
+    parser.add_argument("--workers", type = int, default = 4, help = "threads decoding images and running NMS")
+    parser.add_argument("--max-queue", type = int, default = 64, help = "max requests waiting for a batch, the "
+        "next ones get a 503")
+    parser.add_argument("--img-size", type = int, default = utils.IMAGE_SIZE, help = "input size, a multiple of 32")
+    parser.add_argument("--cnf-thres", type = float, default = 0.5, help = "objectness threshold")
+    parser.add_argument("--iou-thres", type = float, default = 0.4, help = "NMS iou threshold")
+    args = parser.parse_args()
+
+    utils.set_image_size(args.img_size)
+    net = neural_net.Yolo3(args.cfg)
+    net.load_weights(args.weights, fused = True)
+
+    # warm up, so that the first requests don't pay for the allocations and the grid caches
+    with torch.no_grad():
+        net(torch.rand(1, 3, utils.IMAGE_SIZE, utils.IMAGE_SIZE))
+
+    batcher = MicroBatcher(net, args.max_batch, args.max_wait_ms / 1000, args.workers, args.cnf_thres, args.iou_thres,
+        args.max_queue)
+    server = DetectionServer(batcher, utils.read_classes(args.classes))
+    asyncio.run(serve(server, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
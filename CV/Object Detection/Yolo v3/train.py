@@ -1,80 +1,251 @@
+import argparse
+import os
+import time
 from datetime import datetime
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 
 import utils as utils
 import neural_net
+from evaluate import MAPEvaluator
+from checkpoint import CheckpointManager, get_rng_state, set_rng_state
 
-train_label_path = "/Users/Jain/code/cloned/ultralytics/coco128/train/labels/train2017"
-train_image_path = "/Users/Jain/code/cloned/ultralytics/coco128/train/images/train2017"
-train_loader = utils.get_dataloader(train_image_path, train_label_path)
 
-eval_label_path = "/Users/Jain/code/cloned/ultralytics/coco128/eval/labels/train2017"
-eval_image_path = "/Users/Jain/code/cloned/ultralytics/coco128/eval/images/train2017"
-eval_loader = utils.get_dataloader(eval_image_path, eval_label_path)
+def log(log_file, text):
+    if log_file is not None:
+        with open(log_file, "a") as f:
+            f.write(text)
+
+def get_batch_sizes(net_info, batch_size, world_size):
+    """
+    Work out the batch sizes from the cfg. The cfg's batch is the number of images per optimizer step,
+    processed in subdivisions micro-batches. With world_size processes, every process accumulates the
+    gradients of enough micro-batches for all the processes together to see batch images per step.
 
-log_file = "TrainingLog_" + datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S') + ".txt"
+    @param batch_size: images per micro-batch and per process, batch / subdivisions if None
+    @returns micro_batch: images per forward pass and per process
+    @returns accumulation_steps: micro-batches per optimizer step
+    @returns global_batch: images per optimizer step across all processes
+    """
+    cfg_batch = int(net_info["batch"])
+    micro_batch = batch_size or max(1, cfg_batch // int(net_info["subdivisions"]))
+    accumulation_steps = max(1, cfg_batch // (micro_batch * world_size))
+    return micro_batch, accumulation_steps, micro_batch * world_size * accumulation_steps
 
-def save_model_weights(epoch, model):
-    torch.save(model.state_dict(), "model_weights_" + str(epoch) + ".pth")
+def train(args, rank = 0, world_size = 1):
+    """
+    Train the network. With world_size > 1, this runs in every process of a gloo process group
+    and the model is wrapped in DistributedDataParallel. Every process evaluates its own shard of the eval
+    images, only rank 0 logs and saves checkpoints.
+    """
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group("gloo", rank = rank, world_size = world_size)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
 
-def train():
-    EPOCHS = 10
-    net = neural_net.Yolo3("assets/config.cfg")
-    net.load_weights("assets/yolov3.weights")
+    utils.set_image_size(args.img_size)
+    net = neural_net.Yolo3(args.cfg)
+    net.load_weights(args.weights)
+    net.set_precision(args.precision)
+    net.activation_checkpointing = args.activation_checkpointing
+    heads = net.yolo_heads()
+    model = DistributedDataParallel(net) if distributed else net
 
-    batch_size = len(train_loader)
+    # The learning rate of the cfg is meant for its batch size. It is scaled linearly with the global batch.
+    micro_batch, accumulation_steps, global_batch = get_batch_sizes(net.net_info, args.batch_size, world_size)
+    lr = float(net.net_info["learning_rate"]) * global_batch / int(net.net_info["batch"])
     optimizer = optim.SGD(net.parameters(), 
-                        lr=0.001/batch_size, momentum=0.9, 
-                        dampening=0, weight_decay=.0005*batch_size)
-    
-    train_loss = []
-    eval_loss = []
+                        lr=lr, momentum=float(net.net_info["momentum"]), 
+                        dampening=0, weight_decay=float(net.net_info["decay"]))
 
-    for epoch in range (EPOCHS):
-        with open(log_file, "a") as f:
-            f.write("Start Time: " + datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S'))
-            f.write("\n")
-            f.write("Epoch: " + str (epoch))
-            f.write("\n")
+    train_loader = utils.get_dataloader(args.train_images, args.train_labels, shuffle = True, batch_size = micro_batch,
+        num_workers = args.workers, distributed = distributed, seed = args.seed)
+    eval_loader = None
+    if args.eval_images:
+        eval_loader = utils.get_dataloader(args.eval_images, args.eval_labels, batch_size = micro_batch,
+            num_workers = args.workers, shard = (rank, world_size))
+
+    # every process loads the checkpoint, only rank 0 writes them
+    manager = CheckpointManager(args.checkpoint_dir, keep_last = args.keep_last)
+    state = {"epoch": 0, "iteration": 0, "step": 0, "train_loss": [], "eval_loss": [], "eval_map": [],
+        "running_loss": 0, "running_batches": 0}
+    if args.resume:
+        checkpoint = manager.load(None if args.resume == "latest" else args.resume)
+        if checkpoint is not None:
+            net.load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            set_rng_state(checkpoint["rng"])
+            state = checkpoint["state"]
+    if rank != 0:
+        manager.close()
+        manager = None
+
+    def save_checkpoint():
+        if manager is not None:
+            manager.save({"model": net.state_dict(), "optimizer": optimizer.state_dict(),
+                "rng": get_rng_state(), "state": state}, state["step"])
+
+    log_file = None
+    if rank == 0:
+        log_file = "TrainingLog_" + datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S') + ".txt"
+        log(log_file, "Processes: {}, micro-batch: {}, accumulation steps: {}, global batch: {}, lr: {}\n".format(
+            world_size, micro_batch, accumulation_steps, global_batch, lr))
+        log(log_file, "Precision: {}, activation checkpointing: {}\n".format(args.precision,
+            args.activation_checkpointing))
+        if state["epoch"] or state["iteration"]:
+            log(log_file, "Resumed at epoch {}, iteration {}\n".format(state["epoch"], state["iteration"]))
+
+    num_images = 0
+    start_time = time.perf_counter()
+
+    while state["epoch"] < args.epochs:
+        epoch = state["epoch"]
+        log(log_file, "Start Time: " + datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S') + "\n")
+        log(log_file, "Epoch: " + str (epoch) + "\n")
             
-        net.train()
+        model.train()
+        # same order of batches as before an interruption, the ones already trained on are skipped
+        utils.set_loader_epoch(train_loader, epoch, state["iteration"])
+        num_batches = state["iteration"] + len(train_loader)
        
-        train_running_loss = 0
-        for _, (features, labels) in enumerate(train_loader):
-            optimizer.zero_grad()
+        optimizer.zero_grad()
+        for batch_idx, (features, labels) in enumerate(train_loader, state["iteration"]):
+            # the micro-batches left at the end of the epoch make a smaller last step, instead of their
+            # gradients being thrown away
+            step_start = batch_idx - batch_idx % accumulation_steps
+            step_size = min(accumulation_steps, num_batches - step_start)
+            step_done = batch_idx + 1 == step_start + step_size
 
-            detections = net(features)
-            
-            loss = utils.calculate_loss(detections, labels)
-            loss.backward()
-            optimizer.step()
+            # the gradients are only synchronized across processes on the last micro-batch of a step
+            if distributed and not step_done:
+                with model.no_sync():
+                    loss = utils.calculate_loss(model(features), labels, heads, features.shape[2:])
+                    (loss / step_size).backward()
+            else:
+                loss = utils.calculate_loss(model(features), labels, heads, features.shape[2:])
+                (loss / step_size).backward()
+
+            state["running_loss"] += loss.item()
+            state["running_batches"] += 1
+            state["iteration"] = batch_idx + 1
+            num_images += len(features)
+
+            if step_done:
+                optimizer.step()
+                optimizer.zero_grad()
+                state["step"] += 1
+                log(log_file, "Step {}, Loss: {:.4f}, Peak RSS: {:.0f} MB\n".format(state["step"], loss.item(),
+                    utils.get_peak_rss_mb()))
+                if args.checkpoint_every and state["step"] % args.checkpoint_every == 0:
+                    save_checkpoint()
 
-            train_running_loss += loss.item()        
+            if args.max_steps and state["step"] >= args.max_steps:
+                break
         
-        train_epch_loss = train_running_loss/len(train_loader)    
-        with open(log_file, "a") as f:
-            f.write("Epoch {}, Train Loss: {}".format(epoch, train_epch_loss))
-        train_loss.append(train_epch_loss)
+        # the mean over the micro-batches actually trained on, which are fewer after --max-steps
+        train_epch_loss = state["running_loss"]/max(state["running_batches"], 1)
+        log(log_file, "Epoch {}, Train Loss: {}".format(epoch, train_epch_loss))
+        state["train_loss"].append(train_epch_loss)
         
-        net.eval()
-        eval_running_loss = 0
-        with torch.no_grad():
-            for _, (eval_features, eval_labels) in enumerate(eval_loader):
-                eval_detections = net(eval_features)
-                loss = utils.calculate_loss(eval_detections, eval_labels)
-                eval_running_loss += loss.item()
-            
-        eval_epch_loss = eval_running_loss/len(eval_loader)    
-        with open(log_file, "a") as f:
-            f.write("Epoch {}, Eval Loss: {}".format(epoch, eval_epch_loss))
-        eval_loss.append(eval_epch_loss)
+        if eval_loader is not None:
+            net.eval()
+            eval_running_loss = torch.zeros(2)
+            evaluator = MAPEvaluator(heads[0].num_attrs - 5)
+            with torch.no_grad():
+                for _, (eval_features, eval_labels) in enumerate(eval_loader):
+                    eval_detections = net(eval_features)
+                    loss = utils.calculate_loss(eval_detections, eval_labels, heads, eval_features.shape[2:])
+                    eval_running_loss += torch.tensor([loss.item(), 1.0])
+                    evaluator.update(*neural_net.batched_nms(eval_detections, 0.001, 0.6, sort_by_class = False),
+                        eval_labels, eval_features.shape[2:])
+                
+            # the loss and the mAP of all the shards together
+            if distributed:
+                dist.all_reduce(eval_running_loss)
+                evaluator.all_gather()
+            eval_epch_loss = (eval_running_loss[0] / eval_running_loss[1].clamp(min = 1)).item()
+            metrics = evaluator.compute()
+            log(log_file, "Epoch {}, Eval Loss: {}, mAP@0.5: {:.4f}, mAP@0.5:0.95: {:.4f}\n".format(epoch, eval_epch_loss,
+                metrics["map50"], metrics["map"]))
+            state["eval_loss"].append(eval_epch_loss)
+            state["eval_map"].append((metrics["map50"], metrics["map"]))
   
-        with open(log_file, "a") as f:
-            f.write("End Time: " + datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S'))
-            f.write ("\n\n")
+        log(log_file, "End Time: " + datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S') + "\n\n")
+
+        if args.max_steps and state["step"] >= args.max_steps:
+            break
+        state.update(epoch = epoch + 1, iteration = 0, running_loss = 0, running_batches = 0)
+        save_checkpoint()
+
+    if manager is not None:
+        manager.close()
+        net.save_weights_cache("model_weights.pt")
+
+    # throughput of all the processes together
+    elapsed = time.perf_counter() - start_time
+    total_images = torch.tensor(float(num_images))
+    if distributed:
+        dist.all_reduce(total_images)
+        dist.destroy_process_group()
+    if rank == 0:
+        throughput = "Throughput: {:.2f} images/sec with {} processes".format(total_images.item() / elapsed, world_size)
+        log(log_file, throughput + "\n")
+        print(throughput)
+
+def run_worker(local_rank, args):
+    train(args, args.node_rank * args.nprocs + local_rank, args.nnodes * args.nprocs)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Train Yolo v3, optionally with distributed data parallel "
+        "over several processes and hosts (gloo backend).")
+    parser.add_argument("--train-images", required = True, help = "folder of training images")
+    parser.add_argument("--train-labels", required = True, help = "folder of training labels")
+    parser.add_argument("--eval-images", help = "folder of evaluation images")
+    parser.add_argument("--eval-labels", help = "folder of evaluation labels")
+    parser.add_argument("--cfg", default = "assets/config.cfg", help = "the cfg file of the network")
+    parser.add_argument("--weights", default = "assets/yolov3.weights", help = "darknet weights or a .pt cache")
+    parser.add_argument("--epochs", type = int, default = 10)
+    parser.add_argument("--batch-size", type = int, help = "images per micro-batch and process, batch / subdivisions "
+        "of the cfg by default")
+    parser.add_argument("--precision", choices = ["fp32", "bf16"], default = "fp32", help = "bf16 runs the "
+        "forward pass under bfloat16 autocast")
+    parser.add_argument("--activation-checkpointing", action = "store_true", help = "recompute the activations "
+        "of the residual blocks in backward instead of keeping them, which trades compute for memory")
+    parser.add_argument("--img-size", type = int, default = utils.IMAGE_SIZE, help = "input size, a multiple of 32")
+    parser.add_argument("--workers", type = int, default = 0, help = "dataloader workers per process")
+    parser.add_argument("--threads", type = int, help = "torch threads per process, all the cores by default")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--max-steps", type = int, help = "stop after this many optimizer steps")
+    parser.add_argument("--checkpoint-dir", default = "checkpoints", help = "where the checkpoints are written")
+    parser.add_argument("--checkpoint-every", type = int, help = "also checkpoint every this many optimizer steps "
+        "during an epoch. By default only at the end of every epoch")
+    parser.add_argument("--keep-last", type = int, default = 3, help = "number of checkpoints kept on disk")
+    parser.add_argument("--resume", nargs = "?", const = "latest", help = "resume from this checkpoint, "
+        "the latest one in --checkpoint-dir if no path is given")
+    parser.add_argument("--nprocs", type = int, default = 1, help = "processes per host")
+    parser.add_argument("--nnodes", type = int, default = 1, help = "number of hosts")
+    parser.add_argument("--node-rank", type = int, default = 0, help = "rank of this host")
+    parser.add_argument("--master-addr", default = "127.0.0.1", help = "address of the host with node rank 0")
+    parser.add_argument("--master-port", default = "29500")
+    args = parser.parse_args()
+
+    if args.nprocs * args.nnodes == 1:
+        train(args)
+        return
+
+    os.environ["MASTER_ADDR"] = args.master_addr
+    os.environ["MASTER_PORT"] = str(args.master_port)
+    if args.threads is None:
+        # don't let every process use all the cores
+        args.threads = max(1, (os.cpu_count() or 1) // args.nprocs)
+    mp.spawn(run_worker, args = (args,), nprocs = args.nprocs)
 
-        save_model_weights(epoch, net)
 
-train()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
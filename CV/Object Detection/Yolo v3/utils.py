@@ -1,53 +1,149 @@
+import itertools
 import os
+import queue
 import random
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
+import torch.distributed as dist
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
-import torchvision.ops as tvo
-import torch.nn as nn
+from torch.utils.data import DataLoader, DistributedSampler
+import torch.nn.functional as F
 from PIL import Image, ImageDraw
-import numpy as np
 
 import datasets
 
 LAYER_TYPE = "layer_type"
 
+# Height and width of the network input. Any multiple of 32 works, e.g. 320 for throughput or 608 for 
+# accuracy. Use set_image_size to change it.
+IMAGE_SIZE = 416
+
+def set_image_size(size):
+    """
+    Set the global input size of the network.
+    """
+    global IMAGE_SIZE
+    if size <= 0 or size % 32 != 0:
+        raise ValueError("The input size must be a positive multiple of 32, got {}".format(size))
+    IMAGE_SIZE = size
+
 def get_image_transform():
+    """
+    The transform applied to the images once they have been resized to the network input by the dataset.
+    """
     image_transform = transforms.Compose([
-            transforms.Resize([416, 416]),
             transforms.ToTensor()])
 
     return image_transform
 
-def image_to_tensor(image_path):
+def image_to_tensor(image_path, letterbox = True):
     """
-    Converts the input image to a tensor. Before the output is returned, the tensor is 
-    divided by 255 as a file contains values from 0 to 255, but the operations are 
+    Converts the input image to a tensor of shape [1, 3, IMAGE_SIZE, IMAGE_SIZE]. Before the output is 
+    returned, the tensor is divided by 255 as a file contains values from 0 to 255, but the operations are 
     performed on values from 0 to 1.
     
     """
-    image = Image.open(image_path)
-    tform = transforms.Compose([transforms.PILToTensor(), transforms.Resize((416, 416))])
-    img_tensor = tform(image)
+    image = Image.open(image_path).convert("RGB")
+    image = datasets.resize_image(image, (IMAGE_SIZE, IMAGE_SIZE), letterbox)
+    img_tensor = transforms.PILToTensor()(image)
     img_tensor = img_tensor/255
     img_tensor = img_tensor.unsqueeze(0)
     return img_tensor
 
-def get_dataloader(image_folder, label_folder = None, shuffle = False):
+def get_dataloader(image_folder, label_folder = None, shuffle = False, return_paths = False, batch_size = 2,
+    num_workers = 0, prefetch_factor = 2, persistent_workers = False, pin_memory = False, fast_decode = False,
+    cache_dir = None, label_store_file = None, img_size = None, letterbox = True, rect = False, distributed = False,
+    seed = None, shard = None):
     """
     Creates a dataloader for the input images and (optional) labels. 
     @params image_folder: the image folder in which all the images reside.
     @params label_folder: the label folder in which all the corresponding labels reside.
     @params shuffle: If we want the input data to be shuffled or not.
+    @params return_paths: If every batch should also contain the paths of its images.
+    @params batch_size: number of images in a batch.
+    @params num_workers: number of worker processes decoding images. 0 decodes on the main thread.
+    @params prefetch_factor: number of batches loaded in advance by each worker.
+    @params persistent_workers: keep the workers alive between epochs instead of restarting them.
+    @params pin_memory: put the batches in pinned memory, for faster copies to the GPU.
+    @params fast_decode: let the JPEG decoder downscale the images while decoding them.
+    @params cache_dir: if given, the resized images are cached in this directory and decoded only once.
+    @params label_store_file: if given, the parsed labels are saved to/loaded from this .npz file.
+    @params img_size: size of the network input, IMAGE_SIZE if omitted.
+    @params letterbox: keep the aspect ratio of the images and pad them, instead of stretching them.
+    @params rect: batch the images by aspect ratio, each batch having its own (non square) input shape.
+    @params distributed: every process of the (already initialized) process group gets its own shard of
+        the data through a ResumableSampler. Call set_loader_epoch at the start of every epoch.
+    @params seed: sample through a ResumableSampler seeded with seed, the order of an epoch is then
+        reproducible and an interrupted epoch can be resumed, see set_loader_epoch.
+    @params shard: (rank, world_size), only load every world_size-th image starting at rank, in order. Unlike
+        distributed, no image is repeated to even out the shards, e.g. for evaluating on several processes.
 
     @returns train_dataloader: the dataloader corresponding to input data
     """
+    if rect and shuffle:
+        raise ValueError("rect batches are built from images sorted by aspect ratio, they can't be shuffled")
+
     image_transform = get_image_transform()
-    train_data = datasets.ObjectDataSet(image_folder, label_folder_path = label_folder, transform=image_transform)
-    train_dataloader = DataLoader(train_data, batch_size = 2, shuffle = shuffle)
+    train_data = datasets.ObjectDataSet(image_folder, label_folder_path = label_folder, transform=image_transform,
+        return_paths = return_paths, fast_decode = fast_decode, cache_dir = cache_dir, label_store_file = label_store_file,
+        img_size = img_size or IMAGE_SIZE, letterbox = letterbox, rect = rect, batch_size = batch_size)
+
+    # prefetch_factor and persistent_workers are only accepted along with worker processes
+    worker_options = {}
+    if num_workers > 0:
+        worker_options = {"prefetch_factor": prefetch_factor, "persistent_workers": persistent_workers}
+
+    # labels contain a different number of targets per image, they need a collate_fn of their own
+    collate_fn = datasets.collate_targets if label_folder is not None else None
+
+    # the sampler does the shuffling when there is one
+    sampler = None
+    if distributed or seed is not None:
+        sampler = ResumableSampler(train_data, batch_size, shuffle, seed or 0, distributed)
+    if shard is not None:
+        if shuffle or distributed:
+            raise ValueError("A shard is loaded in order, it can't be shuffled or distributed")
+        sampler = range(shard[0], len(train_data), shard[1])
+    train_dataloader = DataLoader(train_data, batch_size = batch_size, shuffle = shuffle and sampler is None,
+        sampler = sampler, num_workers = num_workers, pin_memory = pin_memory, collate_fn = collate_fn,
+        **worker_options)
     return train_dataloader
 
+class ResumableSampler(DistributedSampler):
+    """
+    A DistributedSampler which can start an epoch at any batch. The order of an epoch only depends on
+    the seed and the epoch, so an interrupted epoch is resumed by skipping the indices of the batches
+    already trained on, without loading them. Without distributed, it samples all the images.
+    """
+    def __init__(self, dataset, batch_size, shuffle = True, seed = 0, distributed = False) -> None:
+        num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if distributed else (1, 0)
+        super().__init__(dataset, num_replicas = num_replicas, rank = rank, shuffle = shuffle, seed = seed)
+        self.batch_size = batch_size
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch = 0):
+        super().set_epoch(epoch)
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        return itertools.islice(super().__iter__(), self.start_batch * self.batch_size, None)
+
+    def __len__(self):
+        return max(0, super().__len__() - self.start_batch * self.batch_size)
+
+def set_loader_epoch(loader, epoch, start_batch = 0):
+    """
+    Start an epoch of a loader created with a seed or with distributed, at batch start_batch. The order of
+    the batches only depends on the seed and the epoch, so an epoch interrupted halfway is replayed in the
+    same order when resuming, and the batches already trained on are skipped without being loaded.
+    """
+    if not isinstance(loader.sampler, ResumableSampler):
+        raise ValueError("Only a dataloader created with a seed or with distributed can be resumed")
+    loader.sampler.set_epoch(epoch, start_batch)
+
 def read_classes(classes_file):
     """
     Parses the config file. 
@@ -58,36 +154,108 @@ def read_classes(classes_file):
         lines = [line.lstrip().rstrip() for line in file.readlines()]
     return lines
 
-def draw_rectangle(image_path, detections, classes):
+def unmap_boxes(boxes, original_size, input_shape, letterbox = True):
+    """
+    Map boxes from the coordinates of the network input back to the coordinates of the original image.
+    @param boxes: a [M, >=4] tensor, the first 4 columns being x1, y1, x2, y2
+    @param original_size: (width, height) of the original image
+    @param input_shape: (height, width) of the network input the image was resized to
+    @param letterbox: whether the image was letterboxed or stretched
+    @returns: a copy of boxes with the coordinates mapped and clipped to the image
+    """
+    width, height = original_size
+    new_w, new_h, pad_x, pad_y = datasets.letterbox_params(original_size, input_shape, letterbox)
+
+    boxes = boxes.clone()
+    boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - pad_x) * (width / new_w)).clamp(0, width)
+    boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - pad_y) * (height / new_h)).clamp(0, height)
+    return boxes
+
+def draw_rectangle(image_path, detections, classes, out_dir = "det", input_shape = None, letterbox = True):
     """
     Draw rectangle around the object detected. 
     
     @param image_path: the path of the image
     @param detections: detection coordinates of various objects found in the image
+    @param classes: the names of the classes
+    @param out_dir: the directory in which the image is saved
+    @param input_shape: (height, width) of the network input, (IMAGE_SIZE, IMAGE_SIZE) if omitted
+    @param letterbox: whether the image was letterboxed or stretched to the network input
     """
     file_name = os.path.basename(image_path)
     source_img = Image.open(image_path).convert("RGB")
-    width, height = source_img.size
     
-    # Find the ratio between original width/height and width/height of the input image
-    x_scale = width/416
-    y_scale = height/416
+    # Map the detections from the network input back to the original image
+    detections = unmap_boxes(detections, source_img.size, input_shape or (IMAGE_SIZE, IMAGE_SIZE), letterbox)
     draw = ImageDraw.Draw(source_img)
     for detection in detections:
         # randomly pick a BB color
         rand_color = ["#"+''.join([random.choice('0123456789ABCDEF') for j in range(6)])][0]
 
-        draw.rectangle(((detection[0].item() * x_scale, detection[1].item() * y_scale), 
-            (detection[2].item() * x_scale, detection[3].item() * y_scale)), outline = rand_color, fill=None)
+        draw.rectangle(((detection[0].item(), detection[1].item()), 
+            (detection[2].item(), detection[3].item())), outline = rand_color, fill=None)
 
         draw.text((detection[0].item(), detection[1].item()), classes[int(detection[6].item())] + 
             ", Confidence: " + "{0:.2f}".format((detection[5].item())), fill = rand_color)
     
-    if not os.path.exists('det'):
-        os.makedirs('det')
-    det_path = os.path.join("det", file_name)
+    # several writer threads may get here at the same time
+    os.makedirs(out_dir, exist_ok = True)
+    det_path = os.path.join(out_dir, file_name)
     source_img.save(det_path, "JPEG")
 
+def prefetch(iterable, depth = 2):
+    """
+    Iterate over iterable on a background thread, keeping up to depth items ready in a bounded
+    queue. This overlaps producing the items (e.g. loading images) with consuming them.
+    """
+    items = queue.Queue(maxsize = depth)
+    end_marker = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as error:
+            items.put((None, error))
+        items.put((end_marker, None))
+
+    threading.Thread(target = produce, daemon = True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is end_marker:
+            return
+        yield item
+
+class AsyncWriter:
+    """
+    Runs write jobs (drawing boxes, saving files) on a pool of background threads.
+    At most max_pending jobs can be waiting, submit blocks beyond that. This keeps the memory
+    bounded when writing is slower than inference.
+    """
+    def __init__(self, num_threads = 2, max_pending = 8) -> None:
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def _job_done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        self.executor.submit(fn, *args).add_done_callback(self._job_done)
+
+    def close(self):
+        """
+        Wait for all the pending jobs, and raise the first error encountered by any of them.
+        """
+        self.executor.shutdown(wait = True)
+        if self.errors:
+            raise self.errors[0]
+
 def parse_cfg(cfg_file):
     """
     Parses the config file. 
@@ -153,60 +321,144 @@ def get_mesh_grid(grid_size):
     y_cord_tensor = y.contiguous().view(-1,1).repeat(1,3).view(-1,1)
     return x_cord_tensor, y_cord_tensor
 
-def individual_loss(predicted_tensor, target_labels):
+def get_yolo_layout(heads, input_shape):
     """
-    Calculate loss between prediction and targets corresponding to one image.
+    Describe how the predictions of the yolo heads are laid out in the detection tensor.
+    The rows of every head follow each other, and within a head they are ordered by cell and then by anchor.
+
+    @param heads: the YoloHead modules of the network, in forward order
+    @param input_shape: (height, width) of the network input
+    @returns anchors: [num_anchors, 2] tensor of all the anchors (in pixels), head by head
+    @returns anchor_info: [num_anchors, 6] long tensor. For every anchor: its index within its head,
+        the number of anchors of its head, the stride, grid height and grid width of its head, and
+        the row in the detection tensor at which the head starts.
     """
-    # Create a target tensor from the string of target labels provided.
-    # The number of targets would be less than total number of predictions
-    rows = target_labels.count('\n')
-    label_array = np.fromstring(target_labels, sep=' ').reshape(rows, -1)
-    target_tensor = torch.from_numpy(label_array)
-    
-    # Calculate iou between the target tensor and predicted tensor. This would be a "m x n" matrix,
-    # where "m" is the number of targets and "n" is the number of predictions by the network.
-    predicted_tensor_box = predicted_tensor[:, 0:4] / 416 # the predicted_tensor has already been scaled to actual dimensions
-    target_tensor_box = target_tensor[:, 1:5]
-    iou_tensor = tvo.box_iou(target_tensor_box, predicted_tensor_box)
-
-    # Get the best predicted boxes, i.e. predicted boxes which are closest to ground truth boxes.
-    # Number of best predicted boxes = number of target boxes
-    _, best_indices = torch.max(iou_tensor, 1)
-    predicted_gt_boxes = predicted_tensor_box[best_indices]
-    
-    # Calculate coordinate loss. Coordinate loss is calculated only for the best boxes.
-    predicted_gt_boxes = predicted_gt_boxes.float()
-    target_tensor_box = target_tensor_box.float()
-    coord_loss = nn.BCELoss(reduction="sum")(predicted_gt_boxes[0:2], target_tensor_box[0:2]) + \
-        nn.MSELoss(reduction="sum")(predicted_gt_boxes[2:4], target_tensor_box[2:4])
-
-    # First we retrieve the classes for predicted best (predicted gt) boxes.
-    # Then we calculate class loss, only for the best boxes. 
-    predictedgt_cls_tensor, _ = torch.max(predicted_tensor[best_indices, 5:], 1)
-    class_loss = nn.BCEWithLogitsLoss(reduction="sum")(predictedgt_cls_tensor, target_tensor[:, 0])
-
-    #TODO: Experiment with what I have written in the train.md file
-    # Retrieve the max of iou values between each predicted tensor and all target boxes.
-    # Use these values and confidence value predicted by the network to calculate confidence loss
-    prediction_gt_iou_tensor, _ = torch.max(iou_tensor, 0)
-    prediction_gt_iou_tensor = prediction_gt_iou_tensor.float()
-    conf_loss = nn.BCELoss(reduction="sum")(prediction_gt_iou_tensor, predicted_tensor[:, 5])
-    
-    # Total loss for a particular prediction is summation of all the above 3 losses.
-    loss = coord_loss + class_loss + conf_loss 
+    img_h, img_w = input_shape
+    anchor_info = []
+    offset = 0
+    for head in heads:
+        grid_h, grid_w = img_h // head.stride, img_w // head.stride
+        for anchor_idx in range(head.num_anchors):
+            anchor_info.append([anchor_idx, head.num_anchors, head.stride, grid_h, grid_w, offset])
+        offset += grid_h * grid_w * head.num_anchors
 
-    return loss
+    anchors = torch.cat([head.anchors for head in heads])
+    return anchors, torch.tensor(anchor_info, device = anchors.device)
 
-def calculate_loss(predicted_tensor, target_labels):
+def box_iou_cxcywh(boxes1, boxes2):
     """
-    Calculate the loss between predictions and targets in one batch.
+    IoU between boxes given as x_center, y_center, width, height. The two tensors are broadcasted 
+    against each other, e.g. [B, N, 1, 4] and [B, 1, M, 4] gives a [B, N, M] IoU tensor.
     """
-    assert len(predicted_tensor) == len(target_labels)
+    top_left = torch.max(boxes1[..., :2] - boxes1[..., 2:4] / 2, boxes2[..., :2] - boxes2[..., 2:4] / 2)
+    bottom_right = torch.min(boxes1[..., :2] + boxes1[..., 2:4] / 2, boxes2[..., :2] + boxes2[..., 2:4] / 2)
+    intersection = (bottom_right - top_left).clamp(min = 0).prod(-1)
+    union = boxes1[..., 2:4].prod(-1) + boxes2[..., 2:4].prod(-1) - intersection
+    return intersection / union.clamp(min = 1e-9)
+
+def calculate_loss(predicted_tensor, targets, heads, input_shape = None, ignore_thres = 0.7):
+    """
+    Calculate the loss between predictions and targets of a whole batch at once.
+
+    Every target is assigned to the anchor (over all the heads) whose shape matches its shape best, and
+    to the cell of that head's grid containing its center. The row of the prediction responsible for the 
+    target is then found by index arithmetic on the layout of the detection tensor.
+
+    The loss has three parts:
+    1. Coordinate loss, for the responsible predictions only: BCE between the predicted and the target
+       position of the center within its cell, and MSE between the predicted and target width and height
+       (relative to the input size).
+    2. Class loss, for the responsible predictions only: BCE against the one-hot target class.
+    3. Confidence loss, for all the predictions: BCE against 1 for the responsible predictions and 0 for
+       the others. Predictions overlapping a target of their image by more than ignore_thres are neither
+       right nor wrong and are left out.
+
+    @param predicted_tensor: the [B, N, 85] output of Yolo3.forward
+    @param targets: the [M, 6] targets of the batch as returned by datasets.collate_targets
+    @param heads: the YoloHead modules of the network, see Yolo3.yolo_heads
+    @param input_shape: (height, width) of the network input, (IMAGE_SIZE, IMAGE_SIZE) if omitted
+    @returns: the loss averaged over the images of the batch
+    """
+    batch_size = predicted_tensor.size(0)
+    device = predicted_tensor.device
+    input_shape = input_shape or (IMAGE_SIZE, IMAGE_SIZE)
+    img_h, img_w = input_shape
+    eps = 1e-7
+
+    targets = targets.to(device)
+    image_idx = targets[:, 0].long()
+    target_cls = targets[:, 1].long()
+    target_box = targets[:, 2:6]
 
-    total_loss = 0
-    for i in range(len(predicted_tensor)):
-        loss = individual_loss(predicted_tensor[i], target_labels[i])
-        total_loss =+ loss
-        
-    return total_loss/len(predicted_tensor)
+    # Assign every target to the anchor with the best IoU, as if the target and the anchor were centered 
+    # at the same point.
+    anchors, anchor_info = get_yolo_layout(heads, input_shape)
+    target_wh = target_box[:, 2:4] * torch.tensor([img_w, img_h], device = device, dtype = target_box.dtype)
+    intersection = torch.min(target_wh.unsqueeze(1), anchors.unsqueeze(0)).prod(2)
+    wh_iou = intersection / (target_wh.prod(1, keepdim = True) + anchors.prod(1).unsqueeze(0) - intersection)
+    anchor_idx, num_anchors, stride, grid_h, grid_w, offset = anchor_info[wh_iou.argmax(1)].unbind(1)
 
+    # Find the cell containing the center, and from it the row of the responsible prediction
+    cell_x = torch.min((target_box[:, 0] * grid_w).long(), grid_w - 1).clamp(min = 0)
+    cell_y = torch.min((target_box[:, 1] * grid_h).long(), grid_h - 1).clamp(min = 0)
+    rows = offset + (cell_y * grid_w + cell_x) * num_anchors + anchor_idx
+    responsible = predicted_tensor[image_idx, rows]
+
+    # The predictions have already been decoded: bx = (sigmoid(tx) + cell_x) * stride
+    predicted_xy = responsible[:, 0:2] / stride.unsqueeze(1) - torch.stack((cell_x, cell_y), 1)
+    target_xy = target_box[:, 0:2] * torch.stack((grid_w, grid_h), 1) - torch.stack((cell_x, cell_y), 1)
+    predicted_wh = responsible[:, 2:4] / torch.tensor([img_w, img_h], device = device)
+    coord_loss = F.binary_cross_entropy(predicted_xy.clamp(eps, 1 - eps), target_xy.clamp(0, 1), reduction = "sum") + \
+        F.mse_loss(predicted_wh, target_box[:, 2:4], reduction = "sum")
+
+    target_cls_tensor = F.one_hot(target_cls, responsible.size(1) - 5).to(responsible.dtype)
+    class_loss = F.binary_cross_entropy(responsible[:, 5:].clamp(eps, 1 - eps), target_cls_tensor, reduction = "sum")
+
+    predicted_conf = predicted_tensor[:, :, 4]
+    target_conf = torch.zeros_like(predicted_conf)
+    target_conf[image_idx, rows] = 1
+    conf_mask = torch.ones_like(predicted_conf, dtype = torch.bool)
+
+    if len(targets) > 0:
+        with torch.no_grad():
+            # Pad the targets into a [B, T, 4] tensor, T being the max number of targets of an image, so 
+            # that every prediction is only compared to the targets of its own image. The padding rows
+            # have no area and never overlap anything.
+            order = torch.argsort(image_idx)
+            counts = torch.bincount(image_idx, minlength = batch_size)
+            starts = torch.cumsum(counts, 0) - counts
+            position = torch.arange(len(targets), device = device) - starts[image_idx[order]]
+            padded_boxes = target_box.new_zeros(batch_size, int(counts.max()), 4)
+            padded_boxes[image_idx[order], position] = target_box[order] * torch.tensor([img_w, img_h, img_w, img_h],
+                device = device, dtype = target_box.dtype)
+
+            best_iou, _ = box_iou_cxcywh(predicted_tensor[:, :, None, 0:4], padded_boxes[:, None]).max(2)
+            conf_mask = (best_iou <= ignore_thres) | (target_conf == 1)
+
+    conf_loss = F.binary_cross_entropy(predicted_conf[conf_mask].clamp(eps, 1 - eps), target_conf[conf_mask],
+        reduction = "sum")
+
+    # Total loss for a particular prediction is summation of all the above 3 losses.
+    loss = coord_loss + class_loss + conf_loss
+
+    return loss / batch_size
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process in MB.
+    """
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == "Darwin":
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile (0 to 100) of values, using the nearest rank. 0 if values is empty.
+    """
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[rank]